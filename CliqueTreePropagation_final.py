@@ -3,64 +3,207 @@
 @author: Timo van Donselaar
 """
 
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+from EliminationOrdering import EliminationOrdering
+from VariableElimination import as_dtype
+
+class Cluster:
+    
+    """
+    A cluster of the clique tree: its variables (a set) and its potential.
+    """
+    __slots__ = ("variables", "factor")
+    
+    def __init__(self, variables, factor):
+        self.variables = variables
+        self.factor = factor
+
+class Sepset:
+    
+    """
+    A sepset of the clique tree: its variables (the intersection of its two
+    clusters), the ids of these clusters and its potential, which is None 
+    until the first message is passed over the sepset.
+    """
+    __slots__ = ("variables", "cluster_x", "cluster_y", "factor")
+    
+    def __init__(self, variables, cluster_x, cluster_y, factor=None):
+        self.variables = variables
+        self.cluster_x = cluster_x
+        self.cluster_y = cluster_y
+        self.factor = factor
+
 class CliqueTreePropagation:
     
     from pgmpy.models import BayesianModel
-    from pgmpy.inference.EliminationOrder import WeightedMinFill
     from pgmpy.factors.discrete import DiscreteFactor
-    import copy
     import operator
     
     """
     Initialize this class
-    Define several lists for the variables, cpds, etc.
+    Define several lists for the variables, cpds, etc. The cpds are shared 
+    with the model (they are only read), and the states of every variable are
+    taken from its own cpd.
     """
     def __init__(self, model):
         self.model = model
-        self.cpds = self.copy.deepcopy(model.get_cpds())  
+        self.cpds = list(model.get_cpds())
         self.variables = [self.get_variable_cpd(cpd) for cpd in self.cpds]
-        self.nodes_parents = [list(a) for a in zip(self.copy.deepcopy(self.variables), 
-                            self.copy.deepcopy(self.cpds),
-                            [model.get_parents(x) for x in self.variables])]
-        self.nodes3 = [list(a) for a in zip(self.copy.deepcopy(self.variables), 
-                            self.copy.deepcopy(self.cpds))]
-        self.evidence = []
+        self.nodes_parents = [[variable, cpd, model.get_parents(variable)] 
+                              for variable, cpd in zip(self.variables, self.cpds)]
+        self.evidence = {}
+        # thread pool for propagation, see use_threads
+        self.executor = None
+        self.nr_threads = 1
+        # collects timings and sizes when set, see use_instrument
+        self.instrument = None
         self.cardinality_nodes = model.get_cardinality()
-        self.nodes_states = []
-        for node in self.variables:
-            for cpd in self.cpds:
-                can_break = False
-                for key, value in cpd.state_names.items():
-                    if node == key:
-                        self.nodes_states.append((node, value))
-                        can_break = True
-                        break
-                if can_break:
-                    break
-        self.nodes_states = dict(self.nodes_states)
+        self.nodes_states = {cpd.variable: cpd.state_names[cpd.variable] for cpd in self.cpds}
+        # state name -> state number, for every variable
+        self.state_numbers = {node: {name: no for no, name in enumerate(states)} 
+                              for node, states in self.nodes_states.items()}
     
     """
     Build a clique tree by first calling the moralize function, that gives some
     filler edges, and then calling the triangulate function, that gives the 
-    clusters (cliques). Then the sepsets can be defined.
+    clusters (cliques). The moral graph is kept as a dictionary with the set of
+    neighbors of every variable. Then the sepsets can be defined.
     """
     def build_clique_tree(self):
         self.fill_edges = self.moralize(self.nodes_parents, self.model)
-        self.edges = list(self.model.edges)
-        self.edges.extend(self.fill_edges)
-        self.clusters = self.triangulate(self.variables, self.model, self.edges)
+        self.graph = {variable: set() for variable in self.variables}
+        for variable_1, variable_2 in list(self.model.edges) + self.fill_edges:
+            self.graph[variable_1].add(variable_2)
+            self.graph[variable_2].add(variable_1)
+        self.clusters = self.triangulate(self.graph)
         self.sepsets = self.find_sepsets(self.clusters)
+        self.compile_tree()
         
     """
-    Initialize inference by making a list with cluster-factor pairs. 
-    The factors of the variables (conditional probability table) are 
-    assimilated in the factors of the clusters. Another list it made with
-    cluster-factor-marker triplets.
+    Compile the clique tree, such that propagation does not have to search 
+    through the list of sepsets. Every cluster has an integer id (its index 
+    in self.clusters) and gets an adjacency list with (sepset number, 
+    neighbor id) pairs. For every sepset the ids of its two clusters are kept
+    as a pair as well.
+    The order in which messages are passed during global propagation is 
+    computed here once, as lists of (source, sepset, target) triples. These 
+    messages are also grouped in levels (by the depth of the source in its 
+    tree) of messages that can be passed at the same time: for distributing,
+    all messages of a level have different targets; for collecting, the 
+    messages of a level are grouped per target.
+    Finally every variable gets a home cluster: the smallest cluster that 
+    contains the variable, in which observations for it are entered. When a 
+    sepset containing the variable is smaller than its home cluster, the 
+    smallest such sepset is kept as well, to compute marginals from.
     """
-    def initialize_inference(self):
+    def compile_tree(self):
+        self.sepset_clusters = []
+        self.adjacency = [[] for cluster in self.clusters]
+        for sepset_no, sepset in enumerate(self.sepsets):
+            cluster_x = sepset.cluster_x
+            cluster_y = sepset.cluster_y
+            self.sepset_clusters.append((cluster_x, cluster_y))
+            self.adjacency[cluster_x].append((sepset_no, cluster_y))
+            self.adjacency[cluster_y].append((sepset_no, cluster_x))
+        # the root of the tree is the same cluster global_prop always used; 
+        # when the network falls apart in several trees, every tree that does 
+        # not contain this root gets a root of its own
+        self.root = round(len(self.clusters)/2) if len(self.clusters) > 0 else None
+        self.distribute_schedule = []
+        # for every cluster the root of the tree it belongs to
+        self.tree_of_cluster = [None]*len(self.clusters)
+        roots = [self.root] + list(range(len(self.clusters)))
+        for root in roots:
+            if root != None and self.tree_of_cluster[root] == None:
+                schedule = self.message_schedule(root)
+                self.tree_of_cluster[root] = root
+                for _, _, cluster_y in schedule:
+                    self.tree_of_cluster[cluster_y] = root
+                self.distribute_schedule.extend(schedule)
+        self.collect_schedule = [(cluster_y, sepset_no, cluster_x) 
+            for cluster_x, sepset_no, cluster_y in reversed(self.distribute_schedule)]
+        depth = [0]*len(self.clusters)
+        for cluster_x, _, cluster_y in self.distribute_schedule:
+            depth[cluster_y] = depth[cluster_x] + 1
+        nr_levels = max(depth) if len(self.clusters) > 0 else 0
+        self.distribute_levels = [[] for i in range(nr_levels)]
+        for message in self.distribute_schedule:
+            self.distribute_levels[depth[message[0]]].append(message)
+        self.collect_levels = [{} for i in range(nr_levels)]
+        for message in self.collect_schedule:
+            self.collect_levels[nr_levels - depth[message[0]]].setdefault(message[2], []).append(message)
+        self.collect_levels = [list(level.values()) for level in self.collect_levels]
+        self.home_cluster = {}
+        home_size = {}
+        for cluster_no, cluster in enumerate(self.clusters):
+            size = 1
+            for node in cluster:
+                size = size * self.cardinality_nodes[node]
+            for node in cluster:
+                if node not in home_size or size < home_size[node]:
+                    self.home_cluster[node] = cluster_no
+                    home_size[node] = size
+        self.home_sepset = {}
+        for sepset_no, sepset in enumerate(self.sepsets):
+            size = 1
+            for node in sepset.variables:
+                size = size * self.cardinality_nodes[node]
+            for node in sepset.variables:
+                if size < home_size[node]:
+                    self.home_sepset[node] = sepset_no
+                    home_size[node] = size
+        
+    """
+    Compute the order in which messages flow away from a root cluster, 
+    without recursion. The result is a list of (source, sepset, target) 
+    triples in which every cluster is the target before it is a source, such 
+    that it can be used for distributing evidence from the root. Reversing the 
+    list (and the direction of every triple) gives the order for collecting 
+    evidence to the root.
+    """
+    def message_schedule(self, root):
+        schedule = []
+        visited = [False]*len(self.clusters)
+        visited[root] = True
+        to_visit = [root]
+        for cluster_x in to_visit:
+            for sepset_no, neighbor in self.adjacency[cluster_x]:
+                if not visited[neighbor]:
+                    visited[neighbor] = True
+                    schedule.append((cluster_x, sepset_no, neighbor))
+                    to_visit.append(neighbor)
+        return schedule
+        
+    """
+    Initialize inference by making a list with a Cluster record (cluster and
+    factor) per cluster. The factors of the variables (conditional 
+    probability table) are assimilated in the factors of the clusters. The 
+    values of these (evidence free) potentials are saved, such that a 
+    retraction can restore them without building the potentials again.
+    The potentials are kept as arrays of dtype (numpy.float64 or 
+    numpy.float32). When scaled is True, every potential that receives a 
+    message is normalized (as is every sepset potential), which keeps the 
+    values away from underflow on deep networks with much evidence; this does
+    not change the marginals.
+    """
+    def initialize_inference(self, dtype=np.float64, scaled=False):
+        if self.model == None:
+            raise ValueError("the potentials of a loaded tree cannot be initialized without the model")
+        if self.instrument != None:
+            start_init = timer()
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("dtype should be float32 or float64")
+        self.scaled = scaled
         self.clusters_factors = []
-        self.clusters_factors.clear()
-        nodes_list = self.copy.deepcopy(self.nodes3)
+        # the clusters containing every variable, to find a cluster for a cpd
+        clusters_of_variable = {}
+        for cluster_no, cluster in enumerate(self.clusters):
+            for node in cluster:
+                clusters_of_variable.setdefault(node, []).append(cluster_no)
         for cluster in self.clusters:
             cardinalities = []
             total_cardinality = 1
@@ -69,114 +212,443 @@ class CliqueTreePropagation:
                 cardinalities.append(self.cardinality_nodes[node])
                 total_cardinality = total_cardinality * self.cardinality_nodes[node]
                 state_names[node] = self.nodes_states[node]
-            factor = self.DiscreteFactor(list(cluster), cardinalities, [1]*total_cardinality, state_names)
-            self.clusters_factors.append([cluster, factor])
-        for node in nodes_list:
-            factor = self.copy.deepcopy(node[1].to_factor())
-            for cluster_factor in self.clusters_factors:
-                if set(factor.variables).issubset(cluster_factor[0]):
-                    cluster_factor[1].product(factor, inplace=True)
+            factor = self.DiscreteFactor(list(cluster), cardinalities, np.ones(total_cardinality), state_names)
+            self.clusters_factors.append(Cluster(cluster, as_dtype(factor, self.dtype)))
+        for cpd in self.cpds:
+            factor = as_dtype(cpd.to_factor(), self.dtype)
+            for cluster_no in clusters_of_variable[cpd.variable]:
+                cluster_factor = self.clusters_factors[cluster_no]
+                if set(factor.variables).issubset(cluster_factor.variables):
+                    cluster_factor.factor.product(factor, inplace=True)
+                    as_dtype(cluster_factor.factor, self.dtype)
                     break #break inner loop 
-        # cluster_factor: [set/cluster, factor]
-        self.clusters_fac_mark = []
-        self.clusters_fac_mark.clear()
-        for cluster_factor in self.clusters_factors:
-            self.clusters_fac_mark.append([cluster_factor[0], cluster_factor[1], False])
-        # cluster_fac_mark: [set/cluster, factor, marker]
+        for sepset in self.sepsets:
+            sepset.factor = None
+        self.initial_values = [cluster_factor.factor.values.copy() for cluster_factor in self.clusters_factors]
+        # consistent potentials without evidence, saved by global_prop
+        self.calibrated_values = None
+        self.calibrated_sepsets = None
+        # the clusters that are changed since the tree was last consistent
+        self.dirty = set()
+        self.consistent = False
+        # marginals computed since the evidence or the potentials last changed
+        self.marginals_cache = {}
+        self.compile_messages()
+        if self.instrument != None:
+            for cluster_no, cluster_factor in enumerate(self.clusters_factors):
+                self.instrument.potential(cluster_no, cluster_factor.factor.values.nbytes)
+            self.instrument.phase("initialize inference", timer() - start_init)
+    
+    """
+    Compute for every sepset and both of its clusters how a message is made 
+    with plain arrays, given the order of the variables in the factors of the
+    clusters. The variables of a sepset are kept in the order in which they 
+    appear in its first cluster. For a cluster are stored: the axes to sum 
+    out to get the sepset, the transposition of the result to the order of 
+    the sepset, the transposition back, and the shape to which the sepset is
+    reshaped to be multiplied with the cluster.
+    Every sepset also gets its potential, a factor in the order of the sepset
+    whose values are overwritten by every message (it is the potential of the
+    sepset once a message is passed over it), and a spare buffer of the same
+    shape for the next message, see pass_message.
+    """
+    def compile_messages(self):
+        self.message_axes = []
+        self.sepset_potentials = []
+        self.message_buffers = []
+        for sepset_no, sepset in enumerate(self.sepsets):
+            clusters_vars = [self.clusters_factors[cluster_no].factor.variables 
+                             for cluster_no in self.sepset_clusters[sepset_no]]
+            sepset_vars = [var for var in clusters_vars[0] if var in sepset.variables]
+            axes = {}
+            for cluster_no, cluster_vars in zip(self.sepset_clusters[sepset_no], clusters_vars):
+                sum_axes = tuple(i for i, var in enumerate(cluster_vars) if var not in sepset.variables)
+                kept_vars = [var for var in cluster_vars if var in sepset.variables]
+                to_sepset = tuple(kept_vars.index(var) for var in sepset_vars)
+                from_sepset = tuple(sepset_vars.index(var) for var in kept_vars)
+                shape = tuple(self.cardinality_nodes[var] if var in sepset.variables else 1 
+                              for var in cluster_vars)
+                axes[cluster_no] = (sum_axes, to_sepset, from_sepset, shape)
+            self.message_axes.append(axes)
+            cardinalities = [self.cardinality_nodes[var] for var in sepset_vars]
+            potential = self.DiscreteFactor(sepset_vars, cardinalities, np.zeros(int(np.prod(cardinalities))), 
+                                            {var: self.nodes_states[var] for var in sepset_vars})
+            potential.values = np.zeros(cardinalities, dtype=self.dtype)
+            self.sepset_potentials.append(potential)
+            self.message_buffers.append(np.zeros(cardinalities, dtype=self.dtype))
     
     """
-    Global propagation is performed by first assigning a root cluster 
-    (cluster_x), unmarking all clusters, calling collect evidence with
-    cluster_x, unmarking all clusters and then calling distribute evidence with
-    cluster_x.
+    Global propagation is performed by collecting evidence to the root 
+    cluster and then distributing evidence from the root cluster, following 
+    the message schedules computed in compile_tree. With a thread pool (see 
+    use_threads) the messages of a level are passed in parallel. The first 
+    time this is done without evidence, the consistent potentials are saved;
+    these replace the saved initial potentials, which are not needed anymore.
     """
     def global_prop(self):
-        cluster_x = self.clusters_fac_mark[round(len(self.clusters_fac_mark)/2)]
-        for cluster in self.clusters_fac_mark:
-            cluster[2] = False
-        self.collect_evidence(cluster_x)
-        for cluster in self.clusters_fac_mark:
-            cluster[2] = False
-        self.distribute_evidence(cluster_x)        
+        if self.instrument != None:
+            start_prop = timer()
+        if self.executor == None:
+            for cluster_x, sepset_no, cluster_y in self.collect_schedule:
+                self.pass_message(cluster_x, sepset_no, cluster_y)
+            for cluster_x, sepset_no, cluster_y in self.distribute_schedule:
+                self.pass_message(cluster_x, sepset_no, cluster_y)
+        else:
+            for level in self.collect_levels:
+                self.pass_messages_parallel(level)
+            for level in self.distribute_levels:
+                self.pass_messages_parallel([[message] for message in level])
+        self.dirty.clear()
+        self.consistent = True
+        self.marginals_cache.clear()
+        if self.calibrated_values == None and len(self.evidence) == 0:
+            self.calibrated_values = [cluster_factor.factor.values.copy() for cluster_factor in self.clusters_factors]
+            self.calibrated_sepsets = [as_dtype(sepset.factor.copy(), self.dtype) for sepset in self.sepsets]
+            # retraction and batches start from these potentials from now on
+            self.initial_values = None
+        if self.instrument != None:
+            self.instrument.phase("global propagation", timer() - start_prop)
     
     """
-    For this function a cluster containing queried_var is looked for and from
-    this cluster all other variable are summed out (marginalized). The result
-    is then normalized.
+    Get the normalized marginal of queried_var, see marginals.
     """
     def marginalize(self, queried_var):
-        for cluster_fac_mark in self.clusters_fac_mark:
-            if queried_var in cluster_fac_mark[0]:
-                result_prop = cluster_fac_mark[1].marginalize(list(cluster_fac_mark[0]-{queried_var}), inplace=False)
-        result_prop.normalize(inplace=True)
-        return result_prop
+        return self.marginals([queried_var])[queried_var]
     
     """
-    Enter observations for a variables that are not yet observed. 
+    Get the normalized marginals of the variables in vars (by default all 
+    variables that are not observed) as a dictionary from variable to factor.
+    Every marginal is computed from the smallest potential containing the 
+    variable: its home sepset when the tree is consistent, otherwise its home
+    cluster. The variables are grouped per potential, such that every 
+    potential is visited once. The marginals are cached until the evidence or
+    the potentials change, so the returned factors should not be changed.
+    Observations entered in a consistent tree without propagating them (with
+    enter_observation) are propagated first, so that no sepset that is out of
+    date is used.
+    """
+    def marginals(self, vars=None):
+        if self.consistent and len(self.dirty) > 0:
+            self.propagate_changes()
+        if vars == None:
+            vars = [var for var in self.variables if var not in self.evidence]
+        potentials = {}
+        for var in vars:
+            if var not in self.marginals_cache:
+                if self.consistent and len(self.dirty) == 0 and var in self.home_sepset:
+                    potential = ("sepset", self.home_sepset[var])
+                else:
+                    potential = ("cluster", self.home_cluster[var])
+                potentials.setdefault(potential, []).append(var)
+        for (kind, no), potential_vars in potentials.items():
+            if kind == "sepset":
+                factor = self.sepsets[no].factor
+            else:
+                factor = self.clusters_factors[no].factor
+            for var in potential_vars:
+                marginal = factor.marginalize([x for x in factor.variables if x != var], inplace=False)
+                marginal.normalize(inplace=True)
+                self.marginals_cache[var] = marginal
+        return {var: self.marginals_cache[var] for var in vars}
+    
+    """
+    Get the normalized joint marginal of the variables in queried_vars from the
+    consistent tree. In every tree containing queried variables, the clusters 
+    are reduced to the smallest subtree covering the queried variables, by 
+    repeatedly removing leaves whose queried variables are all in the sepset 
+    with their neighbor. In this subtree the potentials are collected to a 
+    root, where every cluster sends its potential, summed out to the sepset 
+    and the queried variables it holds, divided by the potential of the 
+    sepset. The variables that are summed out do not appear in the rest of the
+    subtree, because of the running intersection property. The results of the
+    different trees are independent and are multiplied. Observations entered
+    without propagating them are propagated first, see marginals.
+    """
+    def joint_marginal(self, queried_vars):
+        if self.consistent and len(self.dirty) > 0:
+            self.propagate_changes()
+        if not self.consistent:
+            raise ValueError("the clique tree is not consistent, perform a propagation first")
+        queried_vars = set(queried_vars)
+        for var in queried_vars:
+            if var not in self.home_cluster:
+                raise ValueError("no variable " + str(var) + " in the clique tree")
+        roots = {}
+        for var in queried_vars:
+            roots.setdefault(self.tree_of_cluster[self.home_cluster[var]], []).append(var)
+        
+        result = None
+        for tree_vars in roots.values():
+            start = self.home_cluster[tree_vars[0]]
+            in_subtree = {start}
+            for _, _, cluster_y in self.message_schedule(start):
+                in_subtree.add(cluster_y)
+            degree = {cluster_no: len(self.adjacency[cluster_no]) for cluster_no in in_subtree}
+            leaves = [cluster_no for cluster_no in in_subtree if degree[cluster_no] == 1]
+            while len(leaves) > 0:
+                leaf = leaves.pop()
+                if degree[leaf] != 1:
+                    continue
+                for sepset_no, neighbor in self.adjacency[leaf]:
+                    if neighbor in in_subtree:
+                        break
+                if (self.clusters[leaf] & queried_vars).issubset(self.sepsets[sepset_no].variables):
+                    in_subtree.remove(leaf)
+                    degree[leaf] = 0
+                    degree[neighbor] = degree[neighbor] - 1
+                    if degree[neighbor] == 1:
+                        leaves.append(neighbor)
+            
+            root = next(iter(in_subtree))
+            schedule = []
+            to_visit = [root]
+            visited = {root}
+            for cluster_x in to_visit:
+                for sepset_no, neighbor in self.adjacency[cluster_x]:
+                    if neighbor in in_subtree and neighbor not in visited:
+                        visited.add(neighbor)
+                        schedule.append((cluster_x, sepset_no, neighbor))
+                        to_visit.append(neighbor)
+            factors = {cluster_no: self.clusters_factors[cluster_no].factor.copy() for cluster_no in in_subtree}
+            for cluster_x, sepset_no, cluster_y in reversed(schedule):
+                factor = factors.pop(cluster_y)
+                keep = self.sepsets[sepset_no].variables | queried_vars
+                factor.marginalize([x for x in factor.variables if x not in keep], inplace=True)
+                factor.divide(self.sepsets[sepset_no].factor, inplace=True)
+                factors[cluster_x].product(factor, inplace=True)
+            factor = factors[root]
+            factor.marginalize([x for x in factor.variables if x not in queried_vars], inplace=True)
+            factor.normalize(inplace=True)
+            if result == None:
+                result = factor
+            else:
+                result.product(factor, inplace=True)
+        return result
+    
+    """
+    Enter observations for variables that are not yet observed. Every 
+    observation is entered in the home cluster of the variable, by multiplying
+    the potential of that cluster with an indicator vector of the observed 
+    state. The ids of the clusters that are changed are returned.
     """
     def enter_observation(self, evidence):
-        for var_1, _ in evidence:
-            for  var_2, _ in self.evidence:
-                if var_1 == var_2:
-                    raise ValueError("already observation for (some of) the variables")
-        self.evidence.extend(evidence)
-        evidence_to_process = evidence
-        cluster_no = 0
-        clusters_changed = 0
-        while len(evidence_to_process)>0 and cluster_no < len(self.clusters_fac_mark):
-            cluster = self.clusters_fac_mark[cluster_no]
-            cluster_changed = False
-            cluster_no = cluster_no + 1            
-            factor = cluster[1]        
-            evidence_processed = []
-            for var, state_name in evidence_to_process:
-                if var in cluster[0]:
-                    values_to_zero = [(var, factor.get_state_no(var, name)) for name in factor.state_names[var] if name != state_name]
-                    slice_ = [slice(None)] * len(factor.variables)
-                    for var, state in values_to_zero:
-                        var_index = factor.variables.index(var)
-                        slice_[var_index] = state
-                        axis = factor.values[tuple(slice_)].ndim
-                        if axis==0:
-                            factor.values[tuple(slice_)] = 0
-                        else:
-                            self.set_to_zero(factor.values[tuple(slice_)], axis)
-                    evidence_processed.append((var, state_name))
-                    cluster_changed = True
-            evidence_to_process[:] = [e for e in evidence_to_process if e not in evidence_processed]
-            if cluster_changed:
-                clusters_changed = clusters_changed + 1
-        return (clusters_changed, cluster_no)
-    
-    """
-    Perform a global_update by calling enter_observation with new_evidence, 
-    which will return the clusters that are changed and the number of changed
-    clusters. When only one cluster is changed, only a distribution of 
-    evidence follows, otherwise a global propagation follows.
+        new_evidence = {}
+        for var, state_name in evidence:
+            if var in self.evidence or var in new_evidence:
+                raise ValueError("already observation for (some of) the variables")
+            if var not in self.home_cluster:
+                raise ValueError("no variable " + str(var) + " in the clique tree")
+            if state_name not in self.state_numbers[var]:
+                raise ValueError("variable " + str(var) + " has no state " + str(state_name))
+            new_evidence[var] = state_name
+        self.evidence.update(new_evidence)
+        clusters_changed = []
+        for var, state_name in new_evidence.items():
+            if self.instrument != None:
+                start_obs = timer()
+            cluster_no = self.home_cluster[var]
+            factor = self.clusters_factors[cluster_no].factor
+            indicator = np.zeros(self.cardinality_nodes[var], dtype=factor.values.dtype)
+            indicator[self.state_numbers[var][state_name]] = 1
+            shape = [1]*len(factor.variables)
+            shape[factor.variables.index(var)] = len(indicator)
+            factor.values *= indicator.reshape(shape)
+            if self.instrument != None:
+                self.instrument.observation(var, cluster_no, timer() - start_obs, factor.values.size)
+            if cluster_no not in clusters_changed:
+                clusters_changed.append(cluster_no)
+        self.dirty.update(clusters_changed)
+        self.marginals_cache.clear()
+        return clusters_changed
+    
+    """
+    Perform a global_update by calling enter_observation with new_evidence. 
+    When the tree was consistent before, only the changes are propagated, 
+    otherwise a global propagation follows.
     """
     def global_update(self, new_evidence):
-        clusters_changed, cluster_no = self.enter_observation(new_evidence)
-        if clusters_changed == 1:
-            for cluster in self.clusters_fac_mark:
-                cluster[2] = False            
-            self.distribute_evidence(self.clusters_fac_mark[cluster_no-1])
+        self.enter_observation(new_evidence)
+        if self.consistent:
+            self.propagate_changes()
         else:
             self.global_prop()
+    
+    """
+    Make a tree that was consistent before some clusters changed (the dirty 
+    clusters) consistent again. In every tree with dirty clusters one of them
+    is taken as root. Evidence is only collected along the paths between the
+    dirty clusters and that root: the other clusters did not change, so the 
+    messages they would send equal the ones stored in the sepsets. Then 
+    evidence is distributed from the root to the whole tree.
+    """
+    def propagate_changes(self):
+        roots = {}
+        for cluster_no in sorted(self.dirty):
+            roots.setdefault(self.tree_of_cluster[cluster_no], []).append(cluster_no)
+        for dirty_clusters in roots.values():
+            root = dirty_clusters[0]
+            schedule = self.message_schedule(root)
+            parent = {cluster_y: cluster_x for cluster_x, _, cluster_y in schedule}
+            # the clusters on the paths between the dirty clusters and the root
+            on_path = {root}
+            for cluster_no in dirty_clusters:
+                while cluster_no not in on_path:
+                    on_path.add(cluster_no)
+                    cluster_no = parent[cluster_no]
+            for cluster_x, sepset_no, cluster_y in reversed(schedule):
+                if cluster_y in on_path:
+                    self.pass_message(cluster_y, sepset_no, cluster_x)
+            for cluster_x, sepset_no, cluster_y in schedule:
+                self.pass_message(cluster_x, sepset_no, cluster_y)
+        self.dirty.clear()
+        self.consistent = True
+        self.marginals_cache.clear()
             
     """
-    Perform a global retraction by clearing the current evidence, calling
-    initialize_inference() and deleting the factors of the sepsts. Possibly
-    some new observations are entered.
+    Copy the saved consistent potentials of the sepsets (which are in the 
+    order of compile_messages) into the sepset potentials.
+    """
+    def restore_sepsets(self):
+        for sepset_no, (sepset, factor) in enumerate(zip(self.sepsets, self.calibrated_sepsets)):
+            potential = self.sepset_potentials[sepset_no]
+            np.copyto(potential.values, factor.values)
+            sepset.factor = potential
+    
+    """
+    Perform a global retraction by clearing the current evidence and copying
+    the saved potentials back. When the consistent potentials without 
+    evidence are saved, these are restored (also for the sepsets), and the 
+    tree is consistent again. Otherwise the initial potentials are restored 
+    and the factors of the sepsets are deleted. Possibly some new observations
+    are entered.
     """
     def global_retraction(self, new_evidence=None):
         self.evidence.clear()
-        self.initialize_inference()
-        for sepset in self.sepsets:
-            if len(sepset) > 3:
-                del sepset[3]
+        if self.calibrated_values != None:
+            for cluster_factor, values in zip(self.clusters_factors, self.calibrated_values):
+                np.copyto(cluster_factor.factor.values, values)
+            self.restore_sepsets()
+            self.consistent = True
+        else:
+            for cluster_factor, values in zip(self.clusters_factors, self.initial_values):
+                np.copyto(cluster_factor.factor.values, values)
+            for sepset in self.sepsets:
+                sepset.factor = None
+            self.consistent = False
+        self.dirty.clear()
+        self.marginals_cache.clear()
         if new_evidence != None:
             self.enter_observation(new_evidence)
+    
+    """
+    Retract the observations of some variables and keep the others. The 
+    potentials are restored as in global_retraction, after which the remaining
+    observations are entered again and propagated with global_update, so when
+    the consistent potentials without evidence are saved, only the messages 
+    along the paths between the observed clusters are collected again.
+    """
+    def retract_observation(self, variables):
+        remaining_evidence = [(var, state_name) for var, state_name in self.evidence.items() 
+                              if var not in variables]
+        self.global_retraction()
+        self.global_update(remaining_evidence)
+        
+    """
+    Propagate many independent cases (each a list of (variable, state) 
+    observations) at once and return the normalized marginals of the 
+    variables in vars (by default all variables), as a dictionary from 
+    variable to an array with a row per case. The potentials of the clusters 
+    and sepsets get an extra first axis for the cases, such that evidence is
+    entered and messages are passed with one array operation for all cases. 
+    When the consistent potentials without evidence are saved, propagation 
+    starts from these. The potentials of the tree itself are not changed. 
+    With batch_size, the cases are propagated in batches of at most that 
+    many cases, to limit memory use.
+    """
+    def propagate_cases(self, cases, vars=None, batch_size=None):
+        if vars == None:
+            vars = self.variables
+        cases = [dict(case) for case in cases]
+        for case in cases:
+            for var, state_name in case.items():
+                if var not in self.home_cluster:
+                    raise ValueError("no variable " + str(var) + " in the clique tree")
+                if state_name not in self.state_numbers[var]:
+                    raise ValueError("variable " + str(var) + " has no state " + str(state_name))
+        if batch_size == None or batch_size >= len(cases):
+            return self.propagate_batch(cases, vars)
+        results = [self.propagate_batch(cases[i:i+batch_size], vars) 
+                   for i in range(0, len(cases), batch_size)]
+        return {var: np.concatenate([result[var] for result in results]) for var in vars}
+    
+    """
+    Propagate a batch of cases (each a dictionary from observed variable to 
+    state), see propagate_cases.
+    """
+    def propagate_batch(self, cases, vars):
+        nr_cases = len(cases)
+        if self.calibrated_values != None:
+            cluster_values = [np.repeat(values[np.newaxis], nr_cases, axis=0) 
+                              for values in self.calibrated_values]
+            sepset_values = []
+            for sepset_no, factor in enumerate(self.calibrated_sepsets):
+                sepset_vars = [var for var in self.clusters_factors[self.sepset_clusters[sepset_no][0]].factor.variables 
+                               if var in factor.variables]
+                values = np.transpose(factor.values, [factor.variables.index(var) for var in sepset_vars])
+                sepset_values.append(np.repeat(values[np.newaxis], nr_cases, axis=0))
+        else:
+            cluster_values = [np.repeat(values[np.newaxis], nr_cases, axis=0) 
+                              for values in self.initial_values]
+            sepset_values = [None]*len(self.sepsets)
+        
+        # enter the evidence with an indicator per observed variable, that is 
+        # one for all states in the cases in which the variable is not observed
+        observed_vars = set()
+        for case in cases:
+            observed_vars.update(case)
+        for var in observed_vars:
+            indicator = np.ones((nr_cases, self.cardinality_nodes[var]), dtype=self.dtype)
+            for case_no, case in enumerate(cases):
+                if var in case:
+                    indicator[case_no] = 0
+                    indicator[case_no, self.state_numbers[var][case[var]]] = 1
+            cluster_no = self.home_cluster[var]
+            cluster_vars = self.clusters_factors[cluster_no].factor.variables
+            shape = [nr_cases] + [1]*len(cluster_vars)
+            shape[1 + cluster_vars.index(var)] = self.cardinality_nodes[var]
+            cluster_values[cluster_no] *= indicator.reshape(shape)
         
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for schedule in (self.collect_schedule, self.distribute_schedule):
+                for cluster_x, sepset_no, cluster_y in schedule:
+                    sum_axes, to_sepset, _, _ = self.message_axes[sepset_no][cluster_x]
+                    _, _, from_sepset, shape = self.message_axes[sepset_no][cluster_y]
+                    r_new = cluster_values[cluster_x].sum(axis=tuple(1 + i for i in sum_axes))
+                    r_new = np.transpose(r_new, (0,) + tuple(1 + i for i in to_sepset))
+                    if self.scaled:
+                        r_new = np.ascontiguousarray(r_new)
+                        self.normalize_values(r_new, cases=True)
+                    r_old = sepset_values[sepset_no]
+                    if r_old is None:
+                        r_change = r_new
+                    else:
+                        r_change = np.divide(r_new, r_old, out=np.zeros_like(r_new), where=r_old != 0)
+                    sepset_values[sepset_no] = r_new
+                    r_change = np.transpose(r_change, (0,) + tuple(1 + i for i in from_sepset))
+                    cluster_values[cluster_y] *= r_change.reshape((nr_cases,) + shape)
+                    if self.scaled:
+                        self.normalize_values(cluster_values[cluster_y], cases=True)
+            
+            result = {}
+            for var in vars:
+                cluster_no = self.home_cluster[var]
+                cluster_vars = self.clusters_factors[cluster_no].factor.variables
+                axis = cluster_vars.index(var)
+                marginal = cluster_values[cluster_no].sum(
+                    axis=tuple(1 + i for i in range(len(cluster_vars)) if i != axis))
+                result[var] = marginal / marginal.sum(axis=1, keepdims=True)
+        return result
+    
     """
     Get the variable of the cpd.
     """
@@ -197,7 +669,7 @@ class CliqueTreePropagation:
     Get the parents of a variable with a certain cpd.
     """
     def get_parents(self, cpd):
-        variables = self.copy.deepcopy(cpd.variables)
+        variables = list(cpd.variables)
         variables.remove(cpd.variable)
         return variables
     
@@ -225,37 +697,24 @@ class CliqueTreePropagation:
         return fill_edges 
     
    
-    def get_neighbors(self, edges, variable):
-        neighbors = []    
-        for edge in edges:
-            if variable in edge:
-                neighbors.append(edge[abs(edge.index(variable) - 1)])
-        return neighbors 
-        
-    
-    def triangulate(self, variables, model, edges):
+    """
+    Triangulate the (moral) graph by eliminating the variables one by one with
+    the weighted min-fill heuristic of EliminationOrdering (ties broken by the
+    weight of the resulting cluster). Every eliminated variable gives a
+    cluster of the variable and its neighbors; only the clusters that are not
+    contained in an earlier cluster are returned. The graph is not changed.
+    """
+    def triangulate(self, graph):
+        ordering, eliminated = EliminationOrdering(graph, self.cardinality_nodes).eliminate(list(graph))
         clusters = []
-        elim_order = self.WeightedMinFill(self.model).get_elimination_order(variables)
-        eliminated = []
-        for variable in elim_order:
-            cluster = []
-            neighbors = self.get_neighbors(edges, variable)
-            cluster.append(variable)
-            for neighbor in neighbors:
-                if neighbor not in eliminated:
-                    cluster.append(neighbor)                              
-            
-            fill_edges = []
-            for i in range(len(cluster)-1):
-                for j in range(i+1,len(cluster)):
-                    if not cluster[j] in self.get_neighbors(edges, cluster[i]):
-                        fill_edges.append((cluster[i], cluster[j]))
-            edges.extend(fill_edges)
-                    
-            cluster = set(cluster)
-            if not any(cluster.issubset(c) for c in clusters):
+        # cluster numbers of the clusters containing a variable
+        clusters_of_variable = {variable: [] for variable in graph}
+        for variable, cluster in zip(ordering, eliminated):
+            # an earlier cluster containing this cluster contains the variable
+            if not any(cluster.issubset(clusters[c]) for c in clusters_of_variable[variable]):
+                for node in cluster:
+                    clusters_of_variable[node].append(len(clusters))
                 clusters.append(cluster)
-            eliminated.append(variable)
         return clusters
     
     
@@ -266,117 +725,169 @@ class CliqueTreePropagation:
     def weight_sepset(self, sepset):
         weight = 1
         for variable in sepset[0]:
-            node = self.get_node_for_variable(self.nodes3, variable)
-            single_weight = len(node[1].get_values())
-            weight = weight * single_weight
+            weight = weight * self.cardinality_nodes[variable]
         return weight
     
-    
+    """
+    Find the sepsets that connect the clusters into a tree (Kruskal): the 
+    candidate sepsets are sorted on largest mass and then smallest weight, and 
+    a candidate is taken when its clusters are not yet in the same tree. Only
+    pairs of clusters that share a variable are candidates; these are found 
+    with an index from variables to the clusters that contain them. The trees
+    are kept in a union-find structure.
+    """
     def find_sepsets(self, clusters):
-        sepsets_all = []
-        sepsets_final = []
-        forest  = [[cluster] for cluster in clusters]
-            
-        for i in range(len(clusters)-1):
-            for j in range(i+1, len(clusters)):
-                if len(clusters[i].intersection(clusters[j])) > 0:
-                    sepset = [clusters[i].intersection(clusters[j]), 
-                          clusters[i], clusters[j]]
-                    sepsets_all.append(sepset)
-        sepsets_plus = [ [s[0], s[1], s[2], (-self.mass_sepset(s), self.weight_sepset(s))] for s in sepsets_all]
+        clusters_of_variable = {}
+        for cluster_no, cluster in enumerate(clusters):
+            for variable in cluster:
+                clusters_of_variable.setdefault(variable, []).append(cluster_no)
+        pairs = set()
+        for cluster_nos in clusters_of_variable.values():
+            for i in range(len(cluster_nos)-1):
+                for j in range(i+1, len(cluster_nos)):
+                    pairs.add((cluster_nos[i], cluster_nos[j]))
+        sepsets_plus = []
+        for i, j in sorted(pairs):
+            sepset = [clusters[i].intersection(clusters[j]), i, j]
+            sepsets_plus.append([sepset[0], i, j, (-self.mass_sepset(sepset), self.weight_sepset(sepset))])
         sepsets_plus.sort(key = self.operator.itemgetter(3))
+        
+        # union-find: the parent of every cluster, a root is its own parent
+        parent = list(range(len(clusters)))
+        size = [1]*len(clusters)
+        def find(cluster_no):
+            while parent[cluster_no] != cluster_no:
+                parent[cluster_no] = parent[parent[cluster_no]]
+                cluster_no = parent[cluster_no]
+            return cluster_no
+        
+        sepsets_final = []
         for sepset in sepsets_plus:
-            tree1 = None
-            tree2 = None
-            for tree in forest:
-                if sepset[1] in tree:
-                    tree1 = tree
-            for tree in forest:
-                if sepset[2] in tree:
-                    tree2 = tree
+            tree1 = find(sepset[1])
+            tree2 = find(sepset[2])
             if tree1 != tree2:
-                sepsets_final.append([sepset[0], sepset[1], sepset[2]])
-                tree1.extend(tree2)
-                forest.remove(tree2)
+                sepsets_final.append(Sepset(sepset[0], sepset[1], sepset[2]))
+                if size[tree1] < size[tree2]:
+                    tree1, tree2 = tree2, tree1
+                parent[tree2] = tree1
+                size[tree1] = size[tree1] + size[tree2]
+                if len(sepsets_final) == len(clusters) - 1:
+                    break
             
         return sepsets_final
     
     
-    def get_cluster_fac_mark(self, cluster_set):
-        for cluster_fac_mark in self.clusters_fac_mark:
-            if cluster_fac_mark[0] == cluster_set:
-                return cluster_fac_mark    
+    """
+    Use a pool of nr_threads threads for global propagation; with None (or 
+    1) messages are passed one by one again. Messages from different 
+    subtrees touch different potentials, and numpy releases the GIL for 
+    operations on large arrays, so trees with large clusters can use more 
+    cores.
+    """
+    def use_threads(self, nr_threads=None):
+        if self.executor != None:
+            self.executor.shutdown()
+            self.executor = None
+        self.nr_threads = 1
+        if nr_threads != None and nr_threads > 1:
+            self.executor = ThreadPoolExecutor(max_workers=nr_threads)
+            self.nr_threads = nr_threads
+    
+    """
+    Report what happens during propagation to instrument (an Instrumentation,
+    or any object with its methods): the time, sizes, operations and 
+    allocated bytes of every message, the time of every observation and of 
+    initialize_inference and global_prop, and the bytes of every potential.
+    With None nothing is reported, which costs a single comparison per call.
+    """
+    def use_instrument(self, instrument=None):
+        self.instrument = instrument
+    
+    """
+    Pass groups of messages with the thread pool: the groups are independent,
+    the messages within a group are passed in order. The groups are divided 
+    in one chunk per thread, to keep the overhead per message low.
+    """
+    def pass_messages_parallel(self, groups):
+        if len(groups) == 1:
+            self.pass_messages(groups[0])
+            return
+        chunk_size = -(-len(groups) // self.nr_threads)
+        chunks = [[message for group in groups[i:i+chunk_size] for message in group] 
+                  for i in range(0, len(groups), chunk_size)]
+        for result in self.executor.map(self.pass_messages, chunks):
+            pass
     
+    def pass_messages(self, messages):
+        for cluster_x, sepset_no, cluster_y in messages:
+            self.pass_message(cluster_x, sepset_no, cluster_y)
     
-    def pass_message(self, cluster_x, sepset_r, cluster_y):        
-        if len(sepset_r) > 3:
-            r_old = sepset_r[3]
-        r_new = cluster_x[1].marginalize(list(cluster_x[0] - sepset_r[0]), inplace=False)
+    """
+    Pass a message from cluster X to cluster Y (both given by their id) over
+    the sepset with number sepset_no, with the axes and buffers made by 
+    compile_messages: the new sepset potential is summed out of X into the
+    spare buffer, the old potential is divided by it in place to get the 
+    ratio (with 0/0 = 0), Y is multiplied by the ratio in place and the 
+    buffers swap roles. Only a mask of the non-zero entries of the sepset is
+    allocated; nothing is aligned by variable name.
+    """
+    def pass_message(self, cluster_x, sepset_no, cluster_y):
+        if self.instrument != None:
+            start_message = timer()
+        sepset = self.sepsets[sepset_no]
+        values_x = self.clusters_factors[cluster_x].factor.values
+        values_y = self.clusters_factors[cluster_y].factor.values
+        sum_axes, _, from_sepset_x, _ = self.message_axes[sepset_no][cluster_x]
+        _, _, from_sepset_y, shape_y = self.message_axes[sepset_no][cluster_y]
+        potential = self.sepset_potentials[sepset_no]
         
-        if len(sepset_r) > 3:
-            r_change = r_new.divide(r_old, inplace=False)
-            sepset_r[3] = r_new
+        r_new = self.message_buffers[sepset_no]
+        np.sum(values_x, axis=sum_axes, out=r_new.transpose(from_sepset_x))
+        if self.scaled:
+            self.normalize_values(r_new)
+        divided = sepset.factor != None
+        if divided:
+            r_change = potential.values
+            nonzero = r_change != 0
+            np.divide(r_new, r_change, out=r_change, where=nonzero)
         else:
             r_change = r_new
-            sepset_r.append(r_new)
-
-        cluster_y[1].product(r_change, inplace=True)
-        
-        # sepset is appended to: 
-        # [(sep)set being intersection of X and Y, set/cluster X, set/cluster Y, 
-        #   factor of intersection of X and Y]
-        
+        values_y *= r_change.transpose(from_sepset_y).reshape(shape_y)
+        if self.scaled:
+            self.normalize_values(values_y)
+        self.message_buffers[sepset_no], potential.values = potential.values, r_new
+        sepset.factor = potential
+        if self.instrument != None:
+            self.instrument.message(cluster_x, sepset_no, cluster_y, timer() - start_message,
+                values_x.size, r_new.size, values_y.size,
+                1, 1 if divided else 0, 1, nonzero.nbytes if divided else 0)
     
-    def collect_evidence(self, cluster_x,  caller=None):
-        # mark X
-        cluster_x[2] = True
-        sepset_x_caller = None
-        for sepset in self.sepsets:
-            if cluster_x[0]==sepset[1]:
-                if caller != None:
-                    if caller[0]==sepset[2]:
-                        sepset_x_caller = sepset
-                neighbor = self.get_cluster_fac_mark(sepset[2])
-                if neighbor[2] == False:
-                    self.collect_evidence(neighbor, cluster_x)
-            if cluster_x[0]==sepset[2]:
-                if caller != None:
-                    if caller[0]==sepset[1]:
-                        sepset_x_caller = sepset
-                neighbor = self.get_cluster_fac_mark(sepset[1])
-                if neighbor[2] == False:
-                    self.collect_evidence(neighbor, cluster_x)
-            
-        if caller != None:
-            self.pass_message(cluster_x, sepset_x_caller ,caller)
+    """
+    Divide the values of a potential by their sum (in place), unless they
+    are all zero. With a first axis for cases, every case is normalized.
+    """
+    def normalize_values(self, values, cases=False):
+        if cases:
+            total = values.reshape(len(values), -1).sum(axis=1)
+            total[total == 0] = 1
+            values /= total.reshape((len(values),) + (1,)*(values.ndim - 1))
+        else:
+            total = values.sum()
+            if total > 0:
+                values /= total
+    
+    """
+    Collect evidence to cluster X: every other cluster in the tree of X sends
+    its message towards X.
+    """
+    def collect_evidence(self, cluster_x):
+        for cluster_y, sepset_no, cluster_z in reversed(self.message_schedule(cluster_x)):
+            self.pass_message(cluster_z, sepset_no, cluster_y)
                 
-        
+    """
+    Distribute evidence from cluster X: messages flow from X to every other
+    cluster in the tree of X.
+    """
     def distribute_evidence(self, cluster_x):
-        # mark X
-        cluster_x[2] = True    
-        neighbors_unmarked = []
-        
-        for sepset in self.sepsets:
-            if cluster_x[0]==sepset[1]:
-                neighbor = self.get_cluster_fac_mark(sepset[2])
-                if neighbor[2] == False:
-                    self.pass_message(cluster_x, sepset , neighbor)
-                    neighbors_unmarked.append(neighbor)
-            if cluster_x[0]==sepset[2]:
-                neighbor = self.get_cluster_fac_mark(sepset[1])
-                if neighbor[2] == False:
-                    self.pass_message(cluster_x, sepset , neighbor)
-                    neighbors_unmarked.append(neighbor)
-            
-        for neighbor in neighbors_unmarked:
-            self.distribute_evidence(neighbor)
-            
-            
-    def set_to_zero(self, array_part, axis_left):
-        assert axis_left > 0, "number of axis should be at least 1"
-        if axis_left == 1:
-            for i in range(len(array_part)):
-                array_part[i] = 0
-        else:
-            for i in range(len(array_part)):
-                self.set_to_zero(array_part[i], axis_left-1)
\ No newline at end of file
+        for cluster_y, sepset_no, cluster_z in self.message_schedule(cluster_x):
+            self.pass_message(cluster_y, sepset_no, cluster_z)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Timo van Donselaar
+"""
+
+import json
+import struct
+
+import numpy as np
+
+from CliqueTreePropagation_final import CliqueTreePropagation, Cluster, Sepset
+from ModelCache import ALIGNMENT, align
+
+# first bytes of a compiled tree file, with the version of the format
+MAGIC = b"CTPTREE1"
+
+"""
+A compiled clique tree is saved in a single file: MAGIC, the length of the
+header (8 bytes, little endian), a JSON header and then the potentials as raw
+arrays, every array starting at a multiple of ALIGNMENT bytes after the start
+of the data (the first multiple of ALIGNMENT after the header). The header
+holds the variables, cardinalities, state names, the clusters (with their
+variables in the order of their potentials), the sepsets (as variables and
+the numbers of their two clusters), the dtype, and for every array its offset
+and shape. The arrays are the potentials of the clusters and sepsets without
+evidence: the consistent potentials when the tree was propagated without
+evidence, otherwise the initial potentials of the clusters.
+"""
+
+"""
+Save a tree on which initialize_inference was called to path. When global_prop
+saved the consistent potentials without evidence, these are saved as well,
+so that a loaded tree is consistent at once.
+"""
+def save_compiled_tree(ctp, path):
+    arrays = []
+    header = {"variables" : list(ctp.variables),
+              "cardinalities" : [int(ctp.cardinality_nodes[var]) for var in ctp.variables],
+              "states" : [list(ctp.nodes_states[var]) for var in ctp.variables],
+              "clusters" : [list(cluster_factor.factor.variables) for cluster_factor in ctp.clusters_factors],
+              "sepsets" : [[list(sepset.variables), sepset.cluster_x, sepset.cluster_y] for sepset in ctp.sepsets],
+              "dtype" : ctp.dtype.name,
+              "scaled" : ctp.scaled,
+              "calibrated" : ctp.calibrated_values != None,
+              "sepset variables" : None,
+              "arrays" : []}
+    if ctp.calibrated_values == None:
+        for values in ctp.initial_values:
+            arrays.append(values)
+    else:
+        for values in ctp.calibrated_values:
+            arrays.append(values)
+        header["sepset variables"] = [list(factor.variables) for factor in ctp.calibrated_sepsets]
+        for factor in ctp.calibrated_sepsets:
+            arrays.append(factor.values)
+    offset = 0
+    for values in arrays:
+        header["arrays"].append([offset, list(values.shape)])
+        offset = align(offset + values.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = align(len(MAGIC) + 8 + len(header_bytes))
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for (array_offset, _), values in zip(header["arrays"], arrays):
+            f.seek(data_start + array_offset)
+            f.write(np.ascontiguousarray(values, dtype=ctp.dtype).tobytes())
+        # the file has to be as long as the memory maps of the last array
+        f.truncate(data_start + offset)
+
+"""
+Make a factor of the tree on the given values without copying them (the 
+constructor of pgmpy copies the values to float64). The maps between state 
+names and numbers of every variable are shared by all factors (pgmpy only 
+adds and removes variables in these maps, it does not change the map of a 
+variable); no_to_name holds the map from number to name per variable.
+"""
+def make_factor(ctp, variables, values, no_to_name):
+    factor = CliqueTreePropagation.DiscreteFactor.__new__(CliqueTreePropagation.DiscreteFactor)
+    factor.variables = list(variables)
+    factor.cardinality = np.array([ctp.cardinality_nodes[var] for var in variables], dtype=int)
+    factor.values = values
+    factor.state_names = {var: ctp.nodes_states[var] for var in variables}
+    factor.name_to_no = {var: ctp.state_numbers[var] for var in variables}
+    factor.no_to_name = {var: no_to_name[var] for var in variables}
+    return factor
+
+"""
+Load a tree saved with save_compiled_tree, without building the tree or the
+potentials again. The saved potentials are memory mapped read-only, so all
+processes that load the same file share them through the page cache. The
+potentials of the clusters that evidence is entered in are mapped
+copy-on-write: they are only copied (per page) when they are changed. The
+message schedules are computed again from the saved tree (which takes time
+linear in the number of clusters). The loaded tree has no model, so
+initialize_inference cannot be called on it.
+"""
+def load_compiled_tree(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(str(path) + " is not a compiled clique tree")
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = align(len(MAGIC) + 8 + header_length)
+    dtype = np.dtype(header["dtype"])
+    read_only = np.memmap(path, dtype=np.uint8, mode="r")
+    copy_on_write = np.memmap(path, dtype=np.uint8, mode="c")
+    def array(no, buffer):
+        offset, shape = header["arrays"][no]
+        count = 1
+        for size in shape:
+            count = count * size
+        return np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+
+    ctp = CliqueTreePropagation.__new__(CliqueTreePropagation)
+    ctp.model = None
+    ctp.variables = header["variables"]
+    ctp.cpds = []
+    ctp.nodes_parents = []
+    ctp.evidence = {}
+    ctp.executor = None
+    ctp.nr_threads = 1
+    ctp.instrument = None
+    ctp.cardinality_nodes = dict(zip(ctp.variables, header["cardinalities"]))
+    ctp.nodes_states = dict(zip(ctp.variables, header["states"]))
+    ctp.state_numbers = {node: {name: no for no, name in enumerate(states)}
+                         for node, states in ctp.nodes_states.items()}
+    no_to_name = {node: dict(enumerate(states)) for node, states in ctp.nodes_states.items()}
+    ctp.clusters = [set(cluster) for cluster in header["clusters"]]
+    ctp.sepsets = [Sepset(set(variables), x, y) for variables, x, y in header["sepsets"]]
+    ctp.compile_tree()
+
+    ctp.dtype = dtype
+    ctp.scaled = header["scaled"]
+    nr_clusters = len(ctp.clusters)
+    cluster_values = [array(no, read_only) for no in range(nr_clusters)]
+    ctp.initial_values = None
+    ctp.calibrated_values = None
+    ctp.calibrated_sepsets = None
+    if header["calibrated"]:
+        ctp.calibrated_values = cluster_values
+        ctp.calibrated_sepsets = []
+        for no, variables in enumerate(header["sepset variables"]):
+            ctp.calibrated_sepsets.append(make_factor(ctp, variables, array(nr_clusters + no, read_only),
+                                                      no_to_name))
+    else:
+        ctp.initial_values = cluster_values
+    ctp.clusters_factors = []
+    for no, (cluster, variables) in enumerate(zip(ctp.clusters, header["clusters"])):
+        ctp.clusters_factors.append(Cluster(cluster, make_factor(ctp, variables, array(no, copy_on_write), no_to_name)))
+    ctp.dirty = set()
+    ctp.consistent = header["calibrated"]
+    ctp.marginals_cache = {}
+    ctp.compile_messages()
+    if header["calibrated"]:
+        ctp.restore_sepsets()
+    return ctp
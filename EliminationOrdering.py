@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Timo van Donselaar
+"""
+
+import heapq
+
+# the heuristics that can be used to find an elimination ordering
+HEURISTICS = ("min-degree", "min-fill", "weighted-min-fill", "min-weight")
+
+class EliminationOrdering:
+
+    """
+    The graph is a dictionary with the set of neighbors of every variable
+    (the interaction graph of the factors), the cardinalities a dictionary
+    with the cardinality of every variable. The graph is not changed.
+    """
+    def __init__(self, graph, cardinalities):
+        self.graph = graph
+        self.cardinalities = cardinalities
+
+    """
+    Cost of eliminating a variable from the graph, for a heuristic:
+    - min-degree: the number of neighbors
+    - min-fill: the number of edges that have to be added between the
+      neighbors
+    - weighted-min-fill: the sum of the weights of these edges, where the
+      weight of an edge is the product of the cardinalities of its variables,
+      with the product of the cardinalities of the variable and its neighbors
+      to break ties
+    - min-weight: the product of the cardinalities of the variable and its
+      neighbors (the size of the factor made when eliminating it)
+    """
+    def cost(self, graph, variable, heuristic):
+        neighbors = list(graph[variable])
+        if heuristic == "min-degree":
+            return len(neighbors)
+        if heuristic == "min-weight":
+            weight = self.cardinalities[variable]
+            for neighbor in neighbors:
+                weight = weight * self.cardinalities[neighbor]
+            return weight
+        fill = 0
+        weight = self.cardinalities[variable]
+        for i in range(len(neighbors)):
+            weight = weight * self.cardinalities[neighbors[i]]
+            for j in range(i+1, len(neighbors)):
+                if neighbors[j] not in graph[neighbors[i]]:
+                    if heuristic == "min-fill":
+                        fill = fill + 1
+                    else:
+                        fill = fill + (self.cardinalities[neighbors[i]]
+                                       * self.cardinalities[neighbors[j]])
+        if heuristic == "min-fill":
+            return fill
+        return (fill, weight)
+
+    """
+    Eliminate variables from (a copy of) the graph with a heuristic, one by
+    one, every time the one with the lowest cost. The costs are kept in a
+    priority queue; after an elimination only the costs of the variables
+    around the eliminated variable are computed again (outdated entries in
+    the queue are skipped). Ties are broken by the position in variables.
+    Returned are the ordering and per eliminated variable the cluster of the
+    variable and its neighbors at the moment it was eliminated.
+    """
+    def eliminate(self, variables, heuristic="weighted-min-fill"):
+        if heuristic not in HEURISTICS:
+            raise ValueError("unknown heuristic " + str(heuristic))
+        graph = {variable: set(neighbors) for variable, neighbors in self.graph.items()}
+        for variable in variables:
+            graph.setdefault(variable, set())
+        to_eliminate = set(variables)
+        position = {variable: i for i, variable in enumerate(variables)}
+        costs = {}
+        queue = []
+        for variable in variables:
+            costs[variable] = self.cost(graph, variable, heuristic)
+            queue.append((costs[variable], position[variable], variable))
+        heapq.heapify(queue)
+
+        ordering = []
+        clusters = []
+        while len(queue) > 0:
+            cost, _, variable = heapq.heappop(queue)
+            if variable not in to_eliminate or costs[variable] != cost:
+                continue
+            to_eliminate.remove(variable)
+            neighbors = graph.pop(variable)
+            ordering.append(variable)
+            clusters.append(neighbors | {variable})
+
+            changed = set(neighbors)
+            for neighbor in neighbors:
+                graph[neighbor].discard(variable)
+                fill_neighbors = neighbors - graph[neighbor] - {neighbor}
+                if len(fill_neighbors) > 0:
+                    graph[neighbor].update(fill_neighbors)
+                    # the fill-in of the neighbors of both ends of the new
+                    # edges changes as well
+                    changed.update(graph[neighbor])
+            for changed_variable in changed & to_eliminate:
+                costs[changed_variable] = self.cost(graph, changed_variable, heuristic)
+                heapq.heappush(queue, (costs[changed_variable], position[changed_variable], changed_variable))
+        return ordering, clusters
+
+    """
+    Get an elimination ordering of variables with a heuristic, see eliminate.
+    Returned are the ordering and the size of the largest factor made during
+    the elimination.
+    """
+    def get_elimination_order(self, variables, heuristic="weighted-min-fill"):
+        ordering, clusters = self.eliminate(variables, heuristic)
+        largest_factor = 1
+        for cluster in clusters:
+            factor_size = 1
+            for variable in cluster:
+                factor_size = factor_size * self.cardinalities[variable]
+            largest_factor = max(largest_factor, factor_size)
+        return ordering, largest_factor
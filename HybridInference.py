@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Timo van Donselaar
+"""
+
+from timeit import default_timer as timer
+
+import numpy as np
+
+from CliqueTreePropagation_final import CliqueTreePropagation
+from VariableElimination import VariableElimination, as_dtype
+
+# the engines a session can be routed to
+ENGINES = ("VE", "CTP")
+
+class HybridInference:
+
+    """
+    Inference that picks variable elimination or clique tree propagation per
+    session, where a session is a run of queries under the same evidence. The
+    costs of both engines are estimated in numbers of table entries that are
+    touched, from the structure of the network:
+    - VE: per query the largest factor of the (pruned) elimination times the
+      number of eliminations, see VariableElimination.query_cost
+    - CTP: compiling (initializing the potentials and a global propagation,
+      once), changing the evidence (a global update when observations are
+      only added, otherwise a retraction, which copies all potentials back,
+      followed by an update) and per query the size of the potential the
+      marginal is computed from.
+    The VE costs are multiplied by the expected number of queries per session,
+    which starts at expected_queries and follows the sessions seen so far.
+    Entries are turned into seconds with a rate per engine, which is
+    recalibrated after every session from the time it took (an exponential
+    moving average with weight smoothing for the newest observation).
+    The clique tree itself is built here, because its cluster and sepset sizes
+    are needed for the estimates; the potentials are only made when a session
+    is routed to CTP for the first time.
+    """
+    def __init__(self, model, expected_queries=1, smoothing=0.3):
+        self.model = model
+        self.smoothing = smoothing
+        self.ve = VariableElimination(model)
+        self.ctp = CliqueTreePropagation(model)
+        self.ctp.build_clique_tree()
+        self.compiled = False
+        # seconds per table entry, the same for both engines until timings are seen
+        self.rates = {"VE" : 1e-7, "CTP" : 1e-7}
+        self.queries_per_session = expected_queries
+        self.nr_sessions = 0
+
+        self.cluster_sizes = []
+        for cluster in self.ctp.clusters:
+            size = 1
+            for node in cluster:
+                size = size * self.ctp.cardinality_nodes[node]
+            self.cluster_sizes.append(size)
+        self.sepset_sizes = []
+        for sepset in self.ctp.sepsets:
+            size = 1
+            for node in sepset.variables:
+                size = size * self.ctp.cardinality_nodes[node]
+            self.sepset_sizes.append(size)
+        # two messages per sepset, each reading the source cluster and
+        # changing the sepset and the target cluster
+        self.propagation_entries = 0
+        for sepset_no, (cluster_x, cluster_y) in enumerate(self.ctp.sepset_clusters):
+            self.propagation_entries += 2 * (self.cluster_sizes[cluster_x] + self.sepset_sizes[sepset_no]
+                                             + self.cluster_sizes[cluster_y])
+        self.compile_entries = sum(self.cluster_sizes) + self.propagation_entries
+        self.retraction_entries = sum(self.cluster_sizes) + sum(self.sepset_sizes)
+
+        self.evidence = None
+        self.engine = None
+        self.session_queries = 0
+        # [engine, estimated entries, seconds] of every session
+        self.history = []
+
+    """
+    Estimated table entries of VE for a query under evidence.
+    """
+    def ve_entries(self, queried_var, evidence):
+        largest_factor, nr_eliminations = self.ve.query_cost(queried_var, evidence)
+        return largest_factor * max(nr_eliminations, 1)
+
+    """
+    Estimated table entries of CTP to go from its current evidence to
+    evidence (a dictionary), including compiling when that is not done yet.
+    """
+    def change_entries(self, evidence):
+        if not self.compiled:
+            return self.compile_entries
+        current = self.ctp.evidence
+        if all(evidence.get(var) == state for var, state in current.items()):
+            if len(evidence) == len(current):
+                return 0
+            return self.propagation_entries
+        return self.retraction_entries + self.propagation_entries
+
+    """
+    Estimated table entries of CTP to compute the marginal of a variable.
+    """
+    def marginal_entries(self, queried_var):
+        if queried_var in self.ctp.home_sepset:
+            return self.sepset_sizes[self.ctp.home_sepset[queried_var]]
+        return self.cluster_sizes[self.ctp.home_cluster[queried_var]]
+
+    """
+    Estimate the seconds a session with evidence would take on both engines,
+    for queries like queried_vars, and return (engine, estimates). Observed
+    variables cost nothing on either engine, see query.
+    """
+    def plan(self, queried_vars, evidence):
+        if len(queried_vars) == 0:
+            raise ValueError("no variables to query")
+        free_vars = [var for var in queried_vars if var not in evidence]
+        nr_queries = max(self.queries_per_session, len(queried_vars))
+        ve_per_query = sum(self.ve_entries(var, evidence) for var in free_vars) / len(queried_vars)
+        ctp_per_query = sum(self.marginal_entries(var) for var in free_vars) / len(queried_vars)
+        estimates = {"VE" : self.rates["VE"] * nr_queries * ve_per_query,
+                     "CTP" : self.rates["CTP"] * (self.change_entries(evidence) + nr_queries * ctp_per_query)}
+        engine = min(ENGINES, key=lambda engine: estimates[engine])
+        return engine, estimates
+
+    """
+    Get the normalized marginals of the variables in queried_vars given the
+    evidence (a list of (variable, state) pairs) as a dictionary from variable
+    to factor. When the evidence differs from that of the previous call a new
+    session starts, which is routed to the engine with the lowest estimated
+    cost; all queries of a session use the same engine. The marginal of an
+    observed variable is the indicator of its observed state, which is made
+    here for both engines.
+    """
+    def query(self, queried_vars, evidence=None):
+        if len(queried_vars) == 0:
+            raise ValueError("no variables to query")
+        evidence = dict(evidence) if evidence != None else {}
+        if evidence != self.evidence:
+            self.end_session()
+            self.evidence = evidence
+            self.engine = self.plan(queried_vars, evidence)[0]
+            self.history.append([self.engine, 0, 0])
+        self.session_queries += len(queried_vars)
+
+        start = timer()
+        results = {var: self.indicator(var, evidence[var]) for var in queried_vars if var in evidence}
+        queried_vars = [var for var in queried_vars if var not in evidence]
+        if len(queried_vars) == 0:
+            entries = 0
+        elif self.engine == "VE":
+            entries = sum(self.ve_entries(var, evidence) for var in queried_vars)
+            if len(queried_vars) == 1:
+                results[queried_vars[0]] = self.ve.query(queried_vars[0], list(evidence.items()))[0]
+            else:
+                results.update(self.ve.query_many(queried_vars, list(evidence.items()))[0])
+        else:
+            entries = self.change_entries(evidence) + sum(self.marginal_entries(var) for var in queried_vars)
+            self.set_ctp_evidence(evidence)
+            results.update(self.ctp.marginals(queried_vars))
+        self.history[-1][1] += entries
+        self.history[-1][2] += timer() - start
+        return results
+
+    """
+    The marginal of a variable observed in state: 1 for that state and 0 for
+    the others.
+    """
+    def indicator(self, var, state):
+        states = self.ctp.nodes_states[var]
+        values = np.zeros(len(states))
+        values[list(states).index(state)] = 1
+        return as_dtype(self.ve.DiscreteFactor([var], [len(states)], values, {var: states}), self.ve.dtype)
+
+    """
+    Bring the clique tree to a consistent state with evidence, compiling it
+    the first time.
+    """
+    def set_ctp_evidence(self, evidence):
+        if not self.compiled:
+            self.ctp.initialize_inference()
+            self.compiled = True
+        current = self.ctp.evidence
+        if all(evidence.get(var) == state for var, state in current.items()):
+            added = [(var, state) for var, state in evidence.items() if var not in current]
+            if len(added) > 0:
+                self.ctp.global_update(added)
+            elif not self.ctp.consistent:
+                self.ctp.global_prop()
+        else:
+            self.ctp.global_retraction(list(evidence.items()) if len(evidence) > 0 else None)
+            if not self.ctp.consistent:
+                self.ctp.global_prop()
+            elif len(self.ctp.dirty) > 0:
+                self.ctp.propagate_changes()
+
+    """
+    Close the current session: update the expected number of queries per
+    session and recalibrate the rate of the engine the session used.
+    """
+    def end_session(self):
+        if self.engine == None:
+            return
+        engine, entries, seconds = self.history[-1]
+        self.nr_sessions += 1
+        # expected_queries counts as the first session
+        self.queries_per_session += (self.session_queries - self.queries_per_session) / (self.nr_sessions + 1)
+        if entries > 0:
+            self.rates[engine] = (1 - self.smoothing) * self.rates[engine] + self.smoothing * seconds / entries
+        self.engine = None
+        self.evidence = None
+        self.session_queries = 0
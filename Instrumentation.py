@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Timo van Donselaar
+"""
+
+import threading
+
+class Instrumentation:
+
+    """
+    Collects what happens inside a clique tree, see
+    CliqueTreePropagation.use_instrument. Every message is kept as a record
+    [cluster x, sepset, cluster y, time, size x, size sepset, size y,
+     multiplications, divisions, marginalizations, bytes allocated]
+    where the sizes are the numbers of entries of the potentials and the
+    operations are counted per factor (as VariableElimination does). Messages
+    can be passed from several threads, so adding records is locked.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.messages = []
+        # [variable, cluster, time, size of the cluster]
+        self.observations = []
+        # [phase, time], e.g. "initialize inference", "global propagation"
+        self.phases = []
+        # cluster -> [time of messages received, messages received,
+        #             messages sent, bytes of the potential]
+        self.clusters = {}
+
+    def cluster_record(self, cluster_no):
+        if cluster_no not in self.clusters:
+            self.clusters[cluster_no] = [0, 0, 0, 0]
+        return self.clusters[cluster_no]
+
+    def message(self, cluster_x, sepset_no, cluster_y, time, size_x, size_sepset, size_y,
+                multiplications, divisions, marginalizations, nr_bytes):
+        with self.lock:
+            self.messages.append([cluster_x, sepset_no, cluster_y, time, size_x, size_sepset, size_y,
+                                  multiplications, divisions, marginalizations, nr_bytes])
+            record_y = self.cluster_record(cluster_y)
+            record_y[0] = record_y[0] + time
+            record_y[1] = record_y[1] + 1
+            self.cluster_record(cluster_x)[2] += 1
+
+    def observation(self, var, cluster_no, time, size):
+        with self.lock:
+            self.observations.append([var, cluster_no, time, size])
+
+    def phase(self, name, time):
+        with self.lock:
+            self.phases.append([name, time])
+
+    def potential(self, cluster_no, nr_bytes):
+        with self.lock:
+            self.cluster_record(cluster_no)[3] = nr_bytes
+
+    """
+    Totals over everything collected, in the form of the analysis of
+    VariableElimination.query.
+    """
+    def summary(self):
+        analysis = {"messages" : len(self.messages),
+                    "message time" : sum(message[3] for message in self.messages),
+                    "multiplications" : sum(message[7] for message in self.messages),
+                    "divisions" : sum(message[8] for message in self.messages),
+                    "marginalizations" : sum(message[9] for message in self.messages),
+                    "bytes allocated" : sum(message[10] for message in self.messages),
+                    "largest factor" : max([message[4] for message in self.messages] + [0]),
+                    "observations" : len(self.observations),
+                    "observation time" : sum(observation[2] for observation in self.observations),
+                    "potential bytes" : sum(record[3] for record in self.clusters.values())}
+        for name, time in self.phases:
+            analysis[name] = analysis.get(name, 0) + time
+        return analysis
+
+    """
+    The clusters (at most amount) in which most time was spent receiving
+    messages, as (cluster, time, messages received, messages sent, bytes of
+    the potential).
+    """
+    def hot_clusters(self, amount=10):
+        ranked = sorted(self.clusters.items(), key=lambda item: item[1][0], reverse=True)
+        return [(cluster_no,) + tuple(record) for cluster_no, record in ranked[:amount]]
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Timo van Donselaar
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+# first bytes of a model cache file, with the version of the format
+MAGIC = b"BNMODEL1"
+# arrays start at multiples of this many bytes (a cache line), in model
+# caches and in compiled clique trees
+ALIGNMENT = 64
+
+class CachedCPD:
+    from pgmpy.factors.discrete import DiscreteFactor
+
+    """
+    A conditional probability table as read from a model cache: the variable,
+    the variables of its factor (the variable itself first, then its
+    parents), their cardinalities, the values in the shape of the factor and
+    the state names of all these variables. It has the attributes of a
+    pgmpy TabularCPD that CliqueTreePropagation and VariableElimination use.
+    """
+    def __init__(self, variable, variables, cardinality, values, state_names):
+        self.variable = variable
+        self.variables = variables
+        self.cardinality = cardinality
+        self.values = values
+        self.state_names = state_names
+
+    def to_factor(self):
+        return self.DiscreteFactor(self.variables, self.cardinality, self.values, self.state_names)
+
+class CachedModel:
+
+    """
+    A Bayesian network as read from a model cache, without the graph and
+    checks of pgmpy: it has nodes, edges, get_cpds, get_parents and
+    get_cardinality as a pgmpy BayesianModel has, which is all the engines
+    need to build from a model.
+    """
+    def __init__(self, cpds):
+        self.cpds = cpds
+        self.nodes = [cpd.variable for cpd in cpds]
+        self.parents = {cpd.variable: cpd.variables[1:] for cpd in cpds}
+        self.edges = [(parent, cpd.variable) for cpd in cpds for parent in cpd.variables[1:]]
+        self.cardinalities = {cpd.variable: cpd.cardinality[0] for cpd in cpds}
+
+    def get_cpds(self):
+        return self.cpds
+
+    def get_parents(self, node):
+        return list(self.parents[node])
+
+    def get_cardinality(self, node=None):
+        if node != None:
+            return self.cardinalities[node]
+        return dict(self.cardinalities)
+
+"""
+The first multiple of ALIGNMENT from offset on.
+"""
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+"""
+The name of the cache file of a network file: the SHA-256 hash of its
+content, such that a changed network gets a new cache file.
+"""
+def cache_name(path):
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest() + ".bnc"
+
+"""
+Write the cpds of a model (a pgmpy BayesianModel or a CachedModel) to a cache
+file: MAGIC, the length of the header (8 bytes, little endian), a JSON header
+with per cpd its variables, cardinalities and state names, and then the
+values of all cpds as one float64 array, starting at a multiple of ALIGNMENT
+bytes. The file is written under another name and then renamed, so that
+processes reading the cache never see half a file.
+"""
+def write_model_cache(model, path):
+    header = []
+    values = []
+    for cpd in model.get_cpds():
+        factor = cpd.to_factor()
+        variables = [cpd.variable] + [var for var in factor.variables if var != cpd.variable]
+        factor_values = np.transpose(factor.values, [factor.variables.index(var) for var in variables])
+        header.append([variables, [int(card) for card in factor_values.shape],
+                       [list(factor.state_names[var]) for var in variables]])
+        values.append(np.ascontiguousarray(factor_values, dtype=np.float64).ravel())
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = align(len(MAGIC) + 8 + len(header_bytes))
+    temporary_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        f.seek(data_start)
+        for cpd_values in values:
+            f.write(cpd_values.tobytes())
+    os.replace(temporary_path, path)
+
+"""
+Read a model cache file into a CachedModel. The whole file is read at once
+and the values of the cpds are (read-only) views of it.
+"""
+def read_model_cache(path):
+    with open(path, "rb") as f:
+        content = f.read()
+    if content[:len(MAGIC)] != MAGIC:
+        raise ValueError(str(path) + " is not a model cache")
+    header_length = struct.unpack("<Q", content[len(MAGIC):len(MAGIC) + 8])[0]
+    header = json.loads(content[len(MAGIC) + 8:len(MAGIC) + 8 + header_length].decode("utf-8"))
+    offset = align(len(MAGIC) + 8 + header_length)
+    cpds = []
+    for variables, cardinality, states in header:
+        count = 1
+        for card in cardinality:
+            count = count * card
+        values = np.frombuffer(content, dtype=np.float64, count=count, offset=offset).reshape(cardinality)
+        offset = offset + 8*count
+        cpds.append(CachedCPD(variables[0], variables, cardinality, values, dict(zip(variables, states))))
+    return CachedModel(cpds)
+
+"""
+Load the network in a BIF or XMLBIF file (by its extension) through the
+cache in cache_dir (by default the directory .model_cache next to the file).
+The file is parsed with pgmpy when the cache does not have it yet and the
+cache is written; the model is then read from the cache, so that every call
+returns a CachedModel. When the cache cannot be written (e.g. a read-only
+directory), the pgmpy model is returned instead.
+"""
+def load_model(path, cache_dir=None):
+    if cache_dir == None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), ".model_cache")
+    cache_path = os.path.join(cache_dir, cache_name(path))
+    if os.path.exists(cache_path):
+        return read_model_cache(cache_path)
+    if path.lower().endswith((".xml", ".xmlbif")):
+        from pgmpy.readwrite import XMLBIF
+        model = XMLBIF.XMLBIFReader(path).get_model()
+    else:
+        from pgmpy.readwrite import BIFReader
+        model = BIFReader(path).get_model()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_model_cache(model, cache_path)
+    except OSError:
+        return model
+    return read_model_cache(cache_path)
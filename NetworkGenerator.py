@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Timo van Donselaar
+"""
+
+import numpy as np
+
+class NetworkGenerator:
+    from pgmpy.models import BayesianModel
+    from pgmpy.factors.discrete import TabularCPD
+
+    """
+    Generator of random Bayesian networks for scaling experiments. All
+    randomness comes from the seed, so the same seed gives the same network.
+    """
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+    """
+    Generate a network with nr_nodes variables X0, X1, ... Every variable gets
+    (up to) parents parents, drawn from the window variables before it, so the
+    treewidth of the network is at most window (the moral graph only has edges
+    between variables less than window apart). Without a window the parents
+    are drawn from all earlier variables. The cardinality is an int, or a
+    (lowest, highest) pair to draw it per variable. The CPDs are drawn from a
+    flat Dirichlet distribution.
+    """
+    def generate(self, nr_nodes, parents=2, cardinality=2, window=None):
+        if nr_nodes < 1:
+            raise ValueError("a network needs at least one node")
+        if window != None and window < parents:
+            raise ValueError("the window must be at least the number of parents")
+        names = ["X" + str(i) for i in range(nr_nodes)]
+        if isinstance(cardinality, int):
+            cards = [cardinality] * nr_nodes
+        else:
+            cards = self.rng.integers(cardinality[0], cardinality[1] + 1, size=nr_nodes).tolist()
+        states = [["s" + str(j) for j in range(card)] for card in cards]
+
+        edges = []
+        node_parents = []
+        for i in range(nr_nodes):
+            first = 0 if window == None else max(0, i - window)
+            amount = min(parents, i - first)
+            chosen = sorted(self.rng.choice(np.arange(first, i), size=amount, replace=False).tolist()) if amount > 0 else []
+            node_parents.append(chosen)
+            for parent in chosen:
+                edges.append((names[parent], names[i]))
+
+        model = self.BayesianModel()
+        model.add_nodes_from(names)
+        model.add_edges_from(edges)
+        cpds = []
+        for i in range(nr_nodes):
+            chosen = node_parents[i]
+            columns = 1
+            for parent in chosen:
+                columns = columns * cards[parent]
+            values = self.rng.dirichlet(np.ones(cards[i]), size=columns).T
+            state_names = {names[i]: states[i]}
+            for parent in chosen:
+                state_names[names[parent]] = states[parent]
+            cpds.append(self.TabularCPD(names[i], cards[i], values,
+                                        evidence=[names[parent] for parent in chosen] or None,
+                                        evidence_card=[cards[parent] for parent in chosen] or None,
+                                        state_names=state_names))
+        # add_cpds compares every CPD with all CPDs added before, which is
+        # quadratic in the number of nodes; there is exactly one CPD per node
+        model.cpds.extend(cpds)
+        return model
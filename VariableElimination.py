@@ -7,92 +7,381 @@ Created on Fri Mar  5 09:14:56 2021
 
 from timeit import default_timer as timer
 from datetime import timedelta
+from collections import deque, OrderedDict
+
+import numpy as np
+
+from EliminationOrdering import EliminationOrdering, HEURISTICS
+
+# markers of the Bayes ball algorithm, kept as bits per node
+VISITED = 1
+MARKED_TOP = 2
+MARKED_BOTTOM = 4
+
+"""
+Set the values of a factor to dtype, the dtype of the potentials of an engine
+(copies of factors made by pgmpy are always float64).
+"""
+def as_dtype(factor, dtype):
+    if factor.values.dtype != dtype:
+        factor.values = factor.values.astype(dtype)
+    return factor
 
 class VariableElimination:
     
     from pgmpy.models import BayesianModel
-    from pgmpy.inference.EliminationOrder import WeightedMinFill
-    import copy    
+    from pgmpy.factors.discrete import DiscreteFactor
+    
+    """
+    Build the engine for a model once: the variables, the parents and 
+    children of every variable and the factors of the cpds are computed here,
+    such that queries do not have to derive or copy the network again. For 
+    the Bayes ball algorithm the variables are numbered and the parents and 
+    children are kept as lists of numbers as well.
+    The heuristic for the elimination ordering is one of HEURISTICS, or 
+    "auto" to try the heuristics one by one (until time_budget seconds are 
+    used) and take the ordering with the smallest largest factor.
+    The factors are kept as arrays of dtype (numpy.float64 or numpy.float32).
+    When scaled is True, every factor made during elimination is normalized, 
+    which keeps the values away from underflow; this does not change the 
+    result.
+    The results of the Bayes ball algorithm and the elimination orderings are
+    cached, each cache holding at most cache_size entries (the least recently
+    used entry is dropped first); clear_caches empties them.
+    """
+    def __init__(self, model, heuristic="weighted-min-fill", time_budget=None, 
+                 dtype=np.float64, scaled=False, cache_size=1024):
+        if heuristic != "auto" and heuristic not in HEURISTICS:
+            raise ValueError("unknown heuristic " + str(heuristic))
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError("dtype should be float32 or float64")
+        self.scaled = scaled
+        self.model = model
+        self.heuristic = heuristic
+        self.time_budget = time_budget
+        self.cardinalities = model.get_cardinality()
+        self.cpds = model.get_cpds()
+        self.variables = [self.get_variable_cpd(cpd) for cpd in self.cpds]
+        self.parents = {}
+        self.children = {variable: [] for variable in self.variables}
+        self.factors = {}
+        for cpd in self.cpds:
+            self.parents[cpd.variable] = self.get_parents(cpd)
+            for parent in self.parents[cpd.variable]:
+                self.children[parent].append(cpd.variable)
+            self.factors[cpd.variable] = as_dtype(cpd.to_factor(), self.dtype)
+        self.index = {variable: i for i, variable in enumerate(self.variables)}
+        self.parent_ids = [[self.index[parent] for parent in self.parents[variable]] 
+                           for variable in self.variables]
+        self.child_ids = [[self.index[child] for child in self.children[variable]] 
+                          for variable in self.variables]
+        self.cache_size = cache_size
+        # results of the Bayes ball algorithm per (queried variable, observed 
+        # variables)
+        self.requisite_cache = OrderedDict()
+        # elimination orderings per (queried variable, relevant variables, 
+        # observed variables in the relevant factors)
+        self.order_cache = OrderedDict()
        
     
     def get_variable_cpd(self, cpd):
         return cpd.variable
-    
-    def get_node_for_variable(l, value):
-        for node in l:
-            if node[0][0] == value:
-                return node
-        # Matches behavior of list.index
-        raise ValueError("list.index(x): x not in list")
         
     def get_parents(self, cpd):
-        variables = self.copy.deepcopy(cpd.variables)
+        variables = list(cpd.variables)
         variables.remove(cpd.variable)
         return variables
     
-    def get_children(cpds, parent_var):
-        children = []
-        for cpd in cpds:
-            if not cpd.variable == parent_var:
-                if parent_var in cpd.variables:
-                    children.append(cpd.variable)
-        return children    
+    """
+    Look up key in a cache and mark it as most recently used; None when the 
+    cache does not have it.
+    """
+    def cached(self, cache, key):
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        return cache[key]
     
     """
-    The Bayes ball algorithm for finding requisite probability nodes (relevant 
-    nodes), requisite observation nodes and irrelevant nodes.
+    Add a result to a cache, dropping the least recently used entry when the
+    cache holds more than cache_size entries.
+    """
+    def store(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+    
+    """
+    Empty the caches of the Bayes ball results and elimination orderings.
     """
-    def bayes_ball(self, nodes, queried_var, evidence=None):
+    def clear_caches(self):
+        self.requisite_cache.clear()
+        self.order_cache.clear()
     
-        # variable, cpd, visited, marked on the top, marked on the bottom
-        nodes_markers = [list(a) for a in zip(self.copy.deepcopy(nodes), 
-                              [False]*len(nodes), [False]*len(nodes), [False]*len(nodes))]
+    """
+    The Bayes ball algorithm for finding requisite probability nodes (relevant 
+    nodes), requisite observation nodes and irrelevant nodes. The evidence is
+    a dictionary (or set) of observed variables; only which variables are 
+    observed matters, so the result is cached per queried variable and set of 
+    observed variables. The returned lists should not be changed.
+    """
+    def bayes_ball(self, queried_var, evidence=None):
+        observed_vars = frozenset(evidence) if evidence != None else frozenset()
+        key = (queried_var, observed_vars)
+        result = self.cached(self.requisite_cache, key)
+        if result != None:
+            return result
+        
+        observed = bytearray(len(self.variables))
+        for variable in observed_vars:
+            observed[self.index[variable]] = 1
+        # visited, marked on the top, marked on the bottom
+        markers = bytearray(len(self.variables))
         # false = visit from chid ; true = visit from parent
-        schedule = [(self.get_node_for_variable(nodes_markers, queried_var), False)]
+        schedule = deque([(self.index[queried_var], False)])
         
         relevant_observed = []
         relevant_nodes = []
         irrelevant = []
         
         while len(schedule)>0:
-            j = schedule.pop(0)
-            j_in_evidence = False
-            j[0][1] = True        
-            if j[0][0][4] != None:
-                j_in_evidence = True
-                relevant_observed.append(j[0][0][0])        
-            if not j_in_evidence and j[1] == False:
-                if not j[0][2]:
-                    j[0][2] = True
-                    relevant_nodes.append(j[0][0][0])
-                    for parent in j[0][0][2]:
-                        parent_node  = self.get_node_for_variable(nodes_markers, parent)
-                        schedule.append((parent_node, False))
-                if not j[0][3]:
-                    j[0][3] = True
-                    for child in j[0][0][3]:
-                        child_node = self.get_node_for_variable(nodes_markers, child)
-                        schedule.append((child_node, True))
-            if j[1] == True:
-                if j_in_evidence and not j[0][2]:
-                    j[0][2] = True
-                    relevant_nodes.append(j[0][0][0])
-                    for parent in j[0][0][2]:
-                        parent_node  = self.get_node_for_variable(nodes_markers, parent)
-                        schedule.append((parent_node, False))
-                if not j_in_evidence and not j[0][3]:
-                    j[0][3] = True
-                    for child in j[0][0][3]:
-                        child_node = self.get_node_for_variable(nodes_markers, child)
-                        schedule.append((child_node, True))            
+            j, from_parent = schedule.popleft()
+            markers[j] |= VISITED
+            if observed[j]:
+                relevant_observed.append(self.variables[j])
+                # an observed node passes the ball from a parent back up
+                if from_parent and not markers[j] & MARKED_TOP:
+                    markers[j] |= MARKED_TOP
+                    relevant_nodes.append(self.variables[j])
+                    for parent in self.parent_ids[j]:
+                        schedule.append((parent, False))
+            else:
+                if not from_parent and not markers[j] & MARKED_TOP:
+                    markers[j] |= MARKED_TOP
+                    relevant_nodes.append(self.variables[j])
+                    for parent in self.parent_ids[j]:
+                        schedule.append((parent, False))
+                if not markers[j] & MARKED_BOTTOM:
+                    markers[j] |= MARKED_BOTTOM
+                    for child in self.child_ids[j]:
+                        schedule.append((child, True))
         
-        for node in nodes_markers:
-            if not node[3]:
-                irrelevant.append(node[0][0])
+        for i in range(len(self.variables)):
+            if not markers[i] & MARKED_BOTTOM:
+                irrelevant.append(self.variables[i])
         
-        return (irrelevant, relevant_nodes, relevant_observed)  
+        result = (irrelevant, relevant_nodes, relevant_observed)
+        self.store(self.requisite_cache, key, result)
+        return result
     
        
+    """
+    Get an elimination ordering for the variables of the (reduced) factors, 
+    given by their scopes, and the size of the largest factor it makes, with 
+    the heuristic of the engine. The orderings are cached under key, which 
+    should identify the factors and the variables to eliminate.
+    """
+    def get_elimination_order(self, variables, scopes, key):
+        result = self.cached(self.order_cache, key)
+        if result != None:
+            return result
+        # interaction graph of the factors
+        graph = {}
+        for scope in scopes:
+            for variable in scope:
+                graph.setdefault(variable, set()).update(x for x in scope if x != variable)
+        ordering = EliminationOrdering(graph, self.cardinalities)
+        if self.heuristic == "auto":
+            start = timer()
+            result = None
+            for heuristic in HEURISTICS:
+                heuristic_result = ordering.get_elimination_order(variables, heuristic)
+                if result == None or heuristic_result[1] < result[1]:
+                    result = heuristic_result
+                if self.time_budget != None and timer() - start > self.time_budget:
+                    break
+        else:
+            result = ordering.get_elimination_order(variables, self.heuristic)
+        self.store(self.order_cache, key, result)
+        return result
+    
+    """
+    Multiply the factors and sum out the variables in sum_out, in one 
+    numpy.einsum call, such that the product of all factors is never made 
+    when the contraction can be done in smaller steps. The variables are 
+    numbered per call, in the order in which they first appear.
+    """
+    def contract(self, factors, sum_out):
+        numbers = {}
+        state_names = {}
+        operands = []
+        for factor in factors:
+            for variable in factor.variables:
+                if variable not in numbers:
+                    numbers[variable] = len(numbers)
+                    state_names[variable] = factor.state_names[variable]
+            operands.append(factor.values)
+            operands.append([numbers[variable] for variable in factor.variables])
+        variables = [variable for variable in numbers if variable not in sum_out]
+        operands.append([numbers[variable] for variable in variables])
+        values = np.einsum(*operands, optimize="greedy")
+        if self.scaled:
+            total = values.sum()
+            if total > 0:
+                values = values / total
+        factor = self.DiscreteFactor(variables, list(np.shape(values)), values, 
+                                     {variable: state_names[variable] for variable in variables})
+        # pgmpy makes the values float64
+        factor.values = np.asarray(values, dtype=self.dtype).reshape(factor.cardinality)
+        return factor
+    
+    """
+    Eliminate the variables in elim_order from the factors and return the 
+    normalized product of the factors that are left, with the number of 
+    multiplications, marginalizations and reused factors. The factors are 
+    given as (key, factor) pairs, where the key identifies the factor. With a
+    cache (a dictionary), every factor made is stored under the eliminated 
+    variable and the keys of the factors it was made from, and it is reused 
+    when the same elimination is done again; its key is its number in the 
+    cache.
+    """
+    def eliminate(self, factors, elim_order, cache=None):
+        nr_multiplications = 0
+        nr_sum_out = 0
+        nr_reused = 0
+        
+        # perform the elimination
+        for variable in elim_order:
+            # the bucket of the current variable to be removed: the factors
+            # that contain it
+            bucket = [(key, factor) for key, factor in factors if variable in factor.variables]
+            # chech wheter the bucket is not empty (in that case there where 
+            # some relevant factors)
+            if len(bucket) > 0:
+                bucket_keys = frozenset(key for key, _ in bucket)
+                if cache != None and (variable, bucket_keys) in cache:
+                    key_new, factor_new = cache[(variable, bucket_keys)]
+                    nr_reused = nr_reused + 1
+                else:
+                    # multiply the factors of the bucket and sum out 
+                    # (marginalize) the to-be-eliminated variable, in one 
+                    # contraction
+                    factor_new = self.contract([factor for _, factor in bucket], [variable])
+                    nr_multiplications = nr_multiplications + len(bucket)
+                    nr_sum_out = nr_sum_out + 1
+                    # every variable is eliminated once, so it identifies 
+                    # the factor when there is no cache
+                    key_new = ("made", variable)
+                    if cache != None:
+                        key_new = len(cache)
+                        cache[(variable, bucket_keys)] = (key_new, factor_new)
+                # remove the factors of the bucket from the list of factors
+                # and add the resultant factor
+                factors = [(key, factor) for key, factor in factors if key not in bucket_keys]
+                factors.append((key_new, factor_new))
+            
+        # all the factors left should now contain only the queried variable
+        # to get the proper probabilities of this variable all factors left are
+        # multiplied and the resulting factor is normalized
+        factor_result = self.contract([factor for _, factor in factors], [])
+        factor_result.normalize()
+        return factor_result, nr_multiplications, nr_sum_out, nr_reused
+    
+    """
+    Answer the queries for all variables in queried_vars under the same 
+    evidence at once. The factors are reduced once, and all queries use (parts
+    of) one elimination ordering of all variables relevant for any of the 
+    queries, such that queries share the first part of their eliminations. 
+    The factors made are cached during the call (keyed by the eliminated 
+    variable and the factors it was made from) and reused by later queries.
+    Returned are a dictionary from queried variable to factor and an analysis
+    of the whole batch.
+    """
+    def query_many(self, queried_vars, evidence=None):
+        start_total = timer()
+        evidence_dict = dict(evidence) if evidence != None else {}
+        
+        start_prune = timer()
+        relevant_per_query = {}
+        for queried_var in queried_vars:
+            relevant_per_query[queried_var] = set(self.bayes_ball(queried_var, evidence_dict)[1])
+        relevant_nodes = set().union(*relevant_per_query.values())
+        end_prune = timer()
+        
+        start_evidence = timer()
+        factors = {}
+        observed = set()
+        for variable in self.variables:
+            if variable in relevant_nodes:
+                factor = self.factors[variable]
+                reduce = [(var, evidence_dict[var]) for var in factor.scope() if var in evidence_dict]
+                if len(reduce) > 0:
+                    factor = as_dtype(factor.reduce(reduce, inplace=False), self.dtype)
+                    observed.update(var for var, _ in reduce)
+                factors[variable] = factor
+        end_evidence = timer()
+        
+        start_order = timer()
+        variables = [x for x in self.variables if x in relevant_nodes and x not in evidence_dict]
+        elim_order, largest_factor = self.get_elimination_order(variables, [factor.scope() for factor in factors.values()],
+            (None, frozenset(relevant_nodes), frozenset(observed)))
+        end_order = timer()
+        
+        start_elim = timer()
+        nr_multiplications = 0
+        nr_sum_out = 0
+        nr_reused = 0
+        cache = {}
+        results = {}
+        for queried_var in queried_vars:
+            relevant = relevant_per_query[queried_var]
+            query_factors = [(("cpd", variable), factors[variable]) for variable in self.variables 
+                             if variable in relevant]
+            query_order = [x for x in elim_order if x in relevant and x != queried_var]
+            factor_result, multiplications, sum_out, reused = self.eliminate(query_factors, query_order, cache)
+            results[queried_var] = factor_result
+            nr_multiplications = nr_multiplications + multiplications
+            nr_sum_out = nr_sum_out + sum_out
+            nr_reused = nr_reused + reused
+        end_elim = timer()
+        end_total = timer()
+        
+        analysis = {"total" : end_total-start_total, 
+                    "evidence" : end_evidence-start_evidence, 
+                    "prune": end_prune-start_prune,
+                    "ordering" : end_order-start_order,
+                    "elimination" : end_elim-start_elim,
+                    "largest factor" : largest_factor,
+                    "multiplications" : nr_multiplications,
+                    "marginalizations" : nr_sum_out,
+                    "reused factors" : nr_reused}
+        return results, analysis
+    
+    """
+    Estimate the cost of a query without answering it: the relevant variables
+    and the elimination ordering are found as query does (the ordering is 
+    cached under the same key, so the query itself reuses it), but no factor
+    is reduced or made. Returned are the size of the largest factor the 
+    elimination makes and the number of variables eliminated.
+    """
+    def query_cost(self, queried_var, evidence=None):
+        evidence_dict = dict(evidence) if evidence != None else {}
+        relevant_nodes = set(self.bayes_ball(queried_var, evidence_dict)[1])
+        scopes = []
+        observed = set()
+        for variable in self.variables:
+            if variable in relevant_nodes:
+                scope = self.factors[variable].scope()
+                observed.update(var for var in scope if var in evidence_dict)
+                scopes.append([var for var in scope if var not in evidence_dict])
+        variables = [x for x in self.variables if x in relevant_nodes and x not in evidence_dict 
+                     and x != queried_var]
+        elim_order, largest_factor = self.get_elimination_order(variables, scopes, 
+            (queried_var, frozenset(relevant_nodes), frozenset(observed)))
+        return largest_factor, len(elim_order)
+    
     """
     Function for finding barren nodes (not used)
     """
@@ -120,37 +409,28 @@ class VariableElimination:
     
     """
     The variable elimination algorithm (included pruning with the Bayes ball
-    algorithm).
+    algorithm), for a model given as argument. This builds a new engine for
+    the model; to answer many queries, build the engine once and use query.
     """
-    def var_elim(self, model, queried_var, evidence=None):
-        
-        # get conditional probabilities from the model
-        cpds = model.get_cpds()
-#        # copy the list of variables, to the list of variables to be eliminated             
-#        variables = self.copy.deepcopy(vars_model)      
-        
-        #variables = model.nodes
-        variables = [self.get_variable_cpd(self, cpd) for cpd in cpds]
-        
-        #variable, cpd, parents, children, evidence
-        nodes = [list(a) for a in zip(self.copy.deepcopy(variables), 
-                      self.copy.deepcopy(cpds), 
-                      [self.get_parents(self, x) for x in self.copy.deepcopy(cpds)],
-                      [self.get_children(cpds, x) for x in self.copy.deepcopy(variables)], 
-                      [None]*len(cpds))]
+    def var_elim(self, model, queried_var, evidence=None, dtype=np.float64):
+        if isinstance(self, VariableElimination) and self.model is model and self.dtype == dtype:
+            return self.query(queried_var, evidence)
+        return VariableElimination(model, dtype=dtype).query(queried_var, evidence)
+    
+    """
+    The variable elimination algorithm (included pruning with the Bayes ball
+    algorithm). The evidence is a list of (variable, state) pairs.
+    """
+    def query(self, queried_var, evidence=None):
         
         start_total = timer()
-            
-        if evidence != None:
-            for node in nodes:        
-                for single_evidence in evidence:
-                    if single_evidence[0] == node[0]:
-                        node[4] = single_evidence                                 
+        
+        evidence_dict = dict(evidence) if evidence != None else {}
         
         start_prune = timer()
         
-        irrelevant, relevant_nodes, relevant_obs = self.bayes_ball(self, nodes, queried_var, evidence)
-        to_prune = [x for x in variables if not x in relevant_nodes]
+        irrelevant, relevant_nodes, relevant_obs = self.bayes_ball(queried_var, evidence_dict)
+        relevant_nodes = set(relevant_nodes)
         
         end_prune = timer()
         
@@ -163,24 +443,24 @@ class VariableElimination:
         #print(barren)
         #print(to_prune)
         
-        variables = [x for x in variables if x not in to_prune] 
+        # an observed variabe does not need to be eliminated
+        variables = [x for x in self.variables if x in relevant_nodes and x not in evidence_dict] 
         
         #time for this subprocess is ignored
         start_evidence = timer()
         
-        # make a list with (possibly reduced) factors
+        # make a list with (possibly reduced) factors, the factors of the 
+        # engine itself are never changed
         factors = []       
-        for node in nodes:
-            if node[0] not in to_prune:
-                factor = node[1].to_factor()
-                if evidence != None:
-                    for single_evidence in evidence:
-                        if single_evidence[0] in factor.scope():
-                            factor.reduce([single_evidence], inplace=True)
-                        if single_evidence[0] in variables:
-                            # an observed variabe does not need to be eliminated
-                            variables.remove(single_evidence[0])
-                factors.append(factor)   
+        observed = set()
+        for variable in self.variables:
+            if variable in relevant_nodes:
+                factor = self.factors[variable]
+                reduce = [(var, evidence_dict[var]) for var in factor.scope() if var in evidence_dict]
+                if len(reduce) > 0:
+                    factor = as_dtype(factor.reduce(reduce, inplace=False), self.dtype)
+                    observed.update(var for var, _ in reduce)
+                factors.append((("cpd", variable), factor))
         
         #time for this subprocess is ignored        
         end_evidence = timer()        
@@ -188,53 +468,15 @@ class VariableElimination:
         # the queried variable should not be eliminated
         variables.remove(queried_var)
         # get an elimination ordering
-        elim_order = self.WeightedMinFill(model).get_elimination_order(variables)
+        start_order = timer()
+        elim_order, largest_factor = self.get_elimination_order(variables, [factor.scope() for _, factor in factors], 
+            (queried_var, frozenset(relevant_nodes), frozenset(observed)))
+        end_order = timer()
     #    print(elim_order)
         
         start_elim = timer()
     
-        nr_multiplications = 0
-        nr_sum_out = 0
-        
-        # perform the elimination
-        for i in range(len(elim_order)):
-            # initialize factor that is the factor after multiplication
-            factor_new = None
-            # initialize list with factors that are multiplied an can be removed
-            factors_to_remove = []
-            for factor in factors:
-                # if the factor contains the current variable to be removed
-                if elim_order[i] in factor.scope():
-                    # if the mulitplication-factor (product) is not yet specified
-                    if factor_new==None:
-                        # then fill the multiplication-factor with ones
-                        factor_new = factor.identity_factor()
-                    # multiply the multiplication-factor with the factor
-                    factor_new.product(factor, inplace=True)
-                    nr_multiplications = nr_multiplications + 1
-                    # add current factor to the to-be-removed list
-                    factors_to_remove.append(factor)
-            # chech wheter multiplication-factor is specified (in that case there
-            # where some relevant factors)
-            if factor_new != None:
-                # remove the to-be-removed factors from the list of factors
-                factors[:] = [f for f in factors if f not in factors_to_remove]
-                # sum out (marginalize) the to-be-eliminated variable from the 
-                # multiplication-factor
-                factor_new.marginalize([elim_order[i]], inplace=True)
-                nr_sum_out = nr_sum_out + 1
-                # add resultant factor to the list of factors
-                factors.append(factor_new)
-            
-        # all the factors left should now contain only the queried variable
-        # to get the proper probabilities of this variable all factors left are
-        # multiplied and the resulting factor is normalized
-        factor_result = None
-        for factor in factors:
-            if factor_result==None:
-                factor_result = factor.identity_factor()
-            factor_result.product(factor, inplace=True)
-        factor_result.normalize()
+        factor_result, nr_multiplications, nr_sum_out, _ = self.eliminate(factors, elim_order)
         
         end_elim = timer()
         end_total = timer()     
@@ -248,7 +490,9 @@ class VariableElimination:
         analysis = {"total" : end_total-start_total, 
                     "evidence" : end_evidence-start_evidence, 
                     "prune": end_prune-start_prune,
+                    "ordering" : end_order-start_order,
                     "elimination" : end_elim-start_elim,
+                    "largest factor" : largest_factor,
                     "multiplications" : nr_multiplications,
                     "marginalizations" : nr_sum_out}
             
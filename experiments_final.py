@@ -5,27 +5,46 @@ Created on Fri Apr  9 09:44:47 2021
 @author: Timo van Donselaar
 """
 
+import argparse
+import csv
+import json
 import random
-import copy
+import sys
 
-from pgmpy.models import BayesianModel
-from pgmpy.readwrite import BIFReader
-from pgmpy.readwrite import XMLBIF
-from pgmpy.readwrite.XMLBeliefNetwork import XBNReader
+from concurrent.futures import ProcessPoolExecutor
+from timeit import default_timer as timer
 
+from CliqueTreePropagation_final import CliqueTreePropagation
+from ModelCache import load_model
+from NetworkGenerator import NetworkGenerator
+from VariableElimination import VariableElimination
 
-from timeit import default_timer as timer
-from datetime import timedelta
+"""
+The scenarios that can be run, with the method of experiment_1 for each.
+"""
+SCENARIOS = {"no-evidence" : "test_without_evidence",
+             "evidence-buildup" : "test_evidence_buildup",
+             "evidence-changes" : "test_evidence_changes"}
 
-from CliqueTreePropagation import CliqueTreePropagation
+"""
+The fields of a result record. Every record is one measured value: the
+network, seed and scenario it belongs to, the step within the scenario
+(e.g. the number of observations), the engine and phase that were measured,
+the value and its unit ("s" for times, "count" otherwise).
+"""
+FIELDS = ["network", "seed", "scenario", "step", "engine", "phase", "value", "unit"]
 
 class experiment_1:
-    
-    def __init__(self, model):
+
+    def __init__(self, model, seed=0, network=""):
         self.model = model
-        self.model_nodes = model.nodes
-        self.model_nodes_shuffled = random.sample(self.model_nodes, len(self.model_nodes))        
-        
+        self.network = network
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.model_nodes = sorted(model.nodes)
+        self.model_nodes_shuffled = self.random.sample(self.model_nodes, len(self.model_nodes))
+        self.ve = VariableElimination(model)
+
         self.nodes_states = []
         for node in self.model_nodes:
             for cpd in model.get_cpds():
@@ -37,125 +56,99 @@ class experiment_1:
                         break
                 if can_break:
                     break
-                        
-        self.nodes_states_shuffled = random.sample(self.nodes_states, len(self.nodes_states))
-        
-    def test_without_evidence(self):
+
+        self.nodes_states_shuffled = self.random.sample(self.nodes_states, len(self.nodes_states))
+        self.records = []
+
+    """
+    Add the values of an analysis to the records, with the scenario, step
+    and engine they belong to.
+    """
+    def record(self, scenario, step, engine, analysis):
+        for phase, value in analysis.items():
+            if value == None:
+                continue
+            unit = "count" if phase in ("amount of clusters", "largest factor", "multiplications",
+                                        "marginalizations", "reused factors") else "s"
+            self.records.append({"network" : self.network, "seed" : self.seed,
+                                 "scenario" : scenario, "step" : step,
+                                 "engine" : engine, "phase" : phase,
+                                 "value" : value, "unit" : unit})
+
+    """
+    Query half of the given nodes with VE and with CTP, and record the
+    average analysis of the queries of both.
+    """
+    def queries(self, scenario, step, query_nodes, evidence=None):
         analysis_ve_queries = []
         analysis_ctp_queries = []
-        analysis_ctp_init = self.init_CTP()
-        analysis_ctp_prop = self.CTP_global_prop()
-        for query_node in random.sample(self.model_nodes, round(len(self.model_nodes)/2)):
+        for query_node in query_nodes:
             #VE(query_node)
-            queried_fac_ve, analysis_ve = self.perform_VE(query_node)
+            queried_fac_ve, analysis_ve = self.perform_VE(query_node, evidence)
             analysis_ve_queries.append(analysis_ve)
-            print(queried_fac_ve)
             #CTP - marginalize(query_node)
             queried_fac_ctp, analysis_ctp_marg = self.CTP_marginalize(query_node)
             analysis_ctp_queries.append(analysis_ctp_marg)
-            print(queried_fac_ctp)
-        analysis_ve_queries_avg = self.average_analysis_queries(analysis_ve_queries)
-        analysis_ctp_queries_avg = self.average_analysis_queries(analysis_ctp_queries)
-        self.show_analysis(["CTP", "CTP", "CTP", "VE"], [analysis_ctp_init, analysis_ctp_prop, analysis_ctp_queries_avg, analysis_ve_queries_avg])
-          
-        
-    def test_evidence_buildup(self, start_it, stop_it):
+        if len(query_nodes) > 0:
+            self.record(scenario, step, "VE", self.average_analysis_queries(analysis_ve_queries))
+            self.record(scenario, step, "CTP", self.average_analysis_queries(analysis_ctp_queries))
+
+    def test_without_evidence(self):
+        scenario = "no-evidence"
+        self.record(scenario, 0, "CTP", self.init_CTP())
+        self.record(scenario, 0, "CTP", self.CTP_global_prop())
+        self.queries(scenario, 0, self.random.sample(self.model_nodes, round(len(self.model_nodes)/2)))
+        return self.records
+
+    def test_evidence_buildup(self):
+        scenario = "evidence-buildup"
         model_nodes_left = list(self.model_nodes)
         evidence = []
-        analysis_ctp_init = self.init_CTP()
-        analysis_ctp_prop = self.CTP_global_prop()
-        analysis_ctp_update_list = []
-        analysis_ve_queries_avg_list = []
-        analysis_ctp_queries_avg_list = []
+        self.record(scenario, 0, "CTP", self.init_CTP())
+        self.record(scenario, 0, "CTP", self.CTP_global_prop())
         evidence_buffer = []
         for i in range(round(len(self.model_nodes)/2)):
-        #for i in range(start_it, stop_it):
             #assign evidence
             node, states = self.nodes_states_shuffled[i]
-            state_assign = random.sample(states, 1)[0]
+            state_assign = self.random.sample(states, 1)[0]
             evidence.append((node, state_assign))
             model_nodes_left.remove(node)
             evidence_buffer.append((node, state_assign))
             if i % 4 == 0:
                 #CTP - enter observation
-                analysis_ctp_update = self.CTP_global_update(evidence_buffer)
+                self.record(scenario, len(evidence), "CTP", self.CTP_global_update(evidence_buffer))
                 evidence_buffer.clear()
-                analysis_ctp_update_list.append(analysis_ctp_update)
-                
-                analysis_ve_queries = []
-                analysis_ctp_queries = []                    
-                
-                for query_node in random.sample(model_nodes_left, round(len(model_nodes_left)/2)):                
-                    #VE(query_node)
-                    queried_fac_ve, analysis_ve = self.perform_VE(query_node, evidence)
-                    analysis_ve_queries.append(analysis_ve)
-                    #CTP - marginalize(query_node)
-                    queried_fac_ctp, analysis_ctp_marg = self.CTP_marginalize(query_node)
-                    analysis_ctp_queries.append(analysis_ctp_marg)
-
-                analysis_ve_queries_avg = self.average_analysis_queries(analysis_ve_queries)
-                analysis_ctp_queries_avg = self.average_analysis_queries(analysis_ctp_queries)
-                analysis_ve_queries_avg_list.append(analysis_ve_queries_avg)
-                analysis_ctp_queries_avg_list.append(analysis_ctp_queries_avg)
-        
-        print("CTP init")        
-        self.show_analysis(['CTP', 'CTP'], [analysis_ctp_init, analysis_ctp_prop])
-        print()        
-        self.show_analysis_list([analysis_ctp_update_list, analysis_ctp_queries_avg_list, analysis_ve_queries_avg_list])   
-    
-    
+                query_nodes = self.random.sample(model_nodes_left, round(len(model_nodes_left)/2))
+                self.queries(scenario, len(evidence), query_nodes, evidence)
+        return self.records
+
     def test_evidence_changes(self):
-        analysis_ctp_init = self.init_CTP()
-        analysis_ctp_prop = self.CTP_global_prop()
-        analysis_ctp_retraction_list = []
-        analysis_ve_queries_avg_list = []
-        analysis_ctp_queries_avg_list = []
+        scenario = "evidence-changes"
+        self.record(scenario, 0, "CTP", self.init_CTP())
+        self.record(scenario, 0, "CTP", self.CTP_global_prop())
 
         for i in range(len(self.model_nodes)):
-            print(i)
-        
             model_nodes_left = list(self.model_nodes)
             evidence = []
-            for node, states in random.sample(self.nodes_states, i):
-                state_assign = random.sample(states, 1)[0]
+            for node, states in self.random.sample(self.nodes_states, i):
+                state_assign = self.random.sample(states, 1)[0]
                 evidence.append((node, state_assign))
                 model_nodes_left.remove(node)
-            
+
             if i % 3 == 0:
                 #CTP - global retraction; global update
-                evidence_CTP = copy.deepcopy(evidence)
-                analysis_ctp_retraction = self.CTP_global_retraction(evidence_CTP)
-                analysis_ctp_retraction_list.append(analysis_ctp_retraction)
-                
-                analysis_ve_queries = []
-                analysis_ctp_queries = []                    
-                
+                self.record(scenario, i, "CTP", self.CTP_global_retraction(list(evidence)))
+
                 amount_of_queries = 0
                 if len(model_nodes_left) > len(self.model_nodes)/2:
                     amount_of_queries = round(len(model_nodes_left)/2)
                 else:
                     amount_of_queries = len(model_nodes_left)
-                
-                for query_node in random.sample(model_nodes_left, amount_of_queries):                
-                    #VE(query_node)
-                    queried_fac_ve, analysis_ve = self.perform_VE(query_node, evidence)
-                    analysis_ve_queries.append(analysis_ve)
-                    #CTP - marginalize(query_node)
-                    queried_fac_ctp, analysis_ctp_marg = self.CTP_marginalize(query_node)
-                    analysis_ctp_queries.append(analysis_ctp_marg)
-
-                analysis_ve_queries_avg = self.average_analysis_queries(analysis_ve_queries)
-                analysis_ctp_queries_avg = self.average_analysis_queries(analysis_ctp_queries)
-                analysis_ve_queries_avg_list.append(analysis_ve_queries_avg)
-                analysis_ctp_queries_avg_list.append(analysis_ctp_queries_avg)
-        
-        print("CTP init")        
-        self.show_analysis(['CTP', 'CTP'], [analysis_ctp_init, analysis_ctp_prop])
-        print()
-        
-        self.show_analysis_list([analysis_ctp_retraction_list, analysis_ctp_queries_avg_list, analysis_ve_queries_avg_list])
-    
-    
+                query_nodes = self.random.sample(model_nodes_left, amount_of_queries)
+                self.queries(scenario, i, query_nodes, evidence)
+        return self.records
+
+
     def average_analysis_queries(self, analysis_queries):
         keys = analysis_queries[0].keys()
         result = {}
@@ -166,46 +159,29 @@ class experiment_1:
             avg_val = sum_val/len(analysis_queries)
             result[key] = avg_val
         return result
-    
-    def show_analysis(self, model_types, analyses):
-        for model_type, analysis in zip(model_types, analyses):
-            for key, value in analysis.items():
-                #print(key, "\t", value)
-                #print(value, end=";")
-                print(value)
-        #print()
-        
-    def show_analysis_list(self, analyses_list):
-        for i in range(len(analyses_list)):
-            for j in range(len(analyses_list[i][0])):
-                for l in range(len(analyses_list[i])):
-                    key, value = list(analyses_list[i][l].items())[j]
-                    print(value, end=" ; ")
-                print()
-            
-
-    def perform_VE(self, query, evidence):
-        from VariableElimination import VariableElimination
-        queried_fac, analysis = VariableElimination.var_elim(VariableElimination, self.model, query, evidence)
+
+
+    def perform_VE(self, query, evidence=None):
+        queried_fac, analysis = self.ve.query(query, evidence)
         return queried_fac, analysis
-        
-    
-    def init_CTP(self):        
+
+
+    def init_CTP(self):
         self.ctp = CliqueTreePropagation(self.model)
         start_build_tree = timer()
         self.ctp.build_clique_tree()
         end_build_tree = timer()
-        
+
         start_init = timer()
         self.ctp.initialize_inference()
         end_init = timer()
         analysis = {"build tree" : end_build_tree-start_build_tree,
-                    "amount of clusters" : len(self.ctp.clusters), 
+                    "amount of clusters" : len(self.ctp.clusters),
                     "initialize inference" : end_init-start_init
                     }
         return analysis
-                
-    
+
+
     def CTP_global_prop(self, evidence = None):
         enter_obs_time = None
         if evidence != None:
@@ -215,48 +191,166 @@ class experiment_1:
             enter_obs_time = end_enter_obs-start_enter_obs
         start_init_prop = timer()
         self.ctp.global_prop()
-        end_init_prop = timer()      
-        analysis = {"enter observation" : enter_obs_time, 
+        end_init_prop = timer()
+        analysis = {"enter observation" : enter_obs_time,
                     "initial propagation" : end_init_prop-start_init_prop
                     }
         return analysis
-        
-    
+
+
     def CTP_global_update(self, evidence):
         start_update = timer()
         self.ctp.global_update(evidence)
         end_update = timer()
         analysis = {"global update" : end_update-start_update}
         return analysis
-        
-    
+
+
     def CTP_global_retraction(self, evidence=None):
         start_retraction_prop = timer()
+        self.ctp.global_retraction()
         if evidence == None:
-            self.ctp.global_retraction()
+            self.ctp.global_prop()
         else:
-            self.ctp.global_retraction(evidence)
-        self.ctp.global_prop()
+            self.ctp.global_update(evidence)
         end_retraction_prop = timer()
         analysis = {"global retraction" : end_retraction_prop-start_retraction_prop}
         return analysis
-        
-    
+
+
     def CTP_marginalize(self, query):
         start_marginalize = timer()
         result = self.ctp.marginalize(query)
         end_marginalize = timer()
         analysis = {"marginalize" : end_marginalize - start_marginalize}
         return result, analysis
-  
-   
-    
-#reader = XMLBIF.XMLBIFReader("")
-reader = BIFReader("")
-
-model = reader.get_model()
-experiment = experiment_1(model)
-#experiment.test_without_evidence()
-#experiment.test_evidence_buildup(0,1)
-experiment.test_evidence_changes()
 
+
+"""
+Read a network from a BIF or XMLBIF file (through the model cache, see
+ModelCache.load_model), or generate one
+from a specification like "synthetic:nodes=1000,parents=2,cardinality=2,window=8"
+(see NetworkGenerator.generate; the cardinality can be a range "2-4", and
+without seed=... the seed of the run is used).
+"""
+def read_network(path, seed=0):
+    if path.startswith("synthetic:"):
+        settings = {}
+        for item in path[len("synthetic:"):].split(","):
+            if item.strip() != "":
+                key, value = item.split("=")
+                settings[key.strip()] = value.strip()
+        cardinality = settings.get("cardinality", "2")
+        if "-" in cardinality:
+            cardinality = tuple(int(card) for card in cardinality.split("-"))
+        else:
+            cardinality = int(cardinality)
+        window = int(settings["window"]) if "window" in settings else None
+        generator = NetworkGenerator(int(settings.get("seed", seed)))
+        return generator.generate(int(settings.get("nodes", 100)), int(settings.get("parents", 2)),
+                                  cardinality, window)
+    return load_model(path)
+
+
+"""
+Run one scenario on one network with one seed and return its records (this
+runs in a worker process).
+"""
+def run_job(job):
+    network, seed, scenario = job
+    model = read_network(network, seed)
+    experiment = experiment_1(model, seed, network)
+    return getattr(experiment, SCENARIOS[scenario])()
+
+
+"""
+Run all combinations of networks, seeds and scenarios in a pool of worker
+processes and return all records.
+"""
+def run_benchmark(networks, seeds, scenarios, workers=None):
+    jobs = [(network, seed, scenario) for network in networks for seed in seeds
+            for scenario in scenarios]
+    records = []
+    if workers == 1:
+        for job in jobs:
+            records.extend(run_job(job))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for job_records in executor.map(run_job, jobs):
+                records.extend(job_records)
+    return records
+
+
+def write_records(records, path):
+    if path.lower().endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(records, f, indent=1)
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+
+
+def read_records(path):
+    if path.lower().endswith(".json"):
+        with open(path) as f:
+            return json.load(f)
+    with open(path, newline="") as f:
+        records = list(csv.DictReader(f))
+    for record in records:
+        record["value"] = float(record["value"])
+    return records
+
+
+"""
+Compare two runs: the mean time of every (network, scenario, engine, phase)
+in both runs, and whether the new run is more than threshold (a fraction)
+slower. Returned are rows (key, old mean, new mean, ratio, regression).
+"""
+def compare_records(old_records, new_records, threshold=0.2):
+    def means(records):
+        sums = {}
+        for record in records:
+            if record["unit"] != "s":
+                continue
+            key = (record["network"], record["scenario"], record["engine"], record["phase"])
+            total, count = sums.get(key, (0, 0))
+            sums[key] = (total + float(record["value"]), count + 1)
+        return {key: total/count for key, (total, count) in sums.items()}
+    old_means = means(old_records)
+    new_means = means(new_records)
+    rows = []
+    for key in sorted(set(old_means) & set(new_means)):
+        ratio = new_means[key]/old_means[key] if old_means[key] > 0 else float("inf")
+        rows.append((key, old_means[key], new_means[key], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark variable elimination against clique tree propagation.")
+    parser.add_argument("networks", nargs="*", help="BIF or XMLBIF files, or synthetic:nodes=...,parents=...,cardinality=...,window=...")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--output", default="results.csv", help="CSV or JSON file for the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        rows = compare_records(read_records(args.compare[0]), read_records(args.compare[1]), args.threshold)
+        for key, old_mean, new_mean, ratio, regression in rows:
+            print(" ; ".join(str(x) for x in key), ";", old_mean, ";", new_mean, ";",
+                  round(ratio, 3), ";", "REGRESSION" if regression else "ok")
+        return 1 if any(row[4] for row in rows) else 0
+
+    if len(args.networks) == 0:
+        parser.error("no networks given")
+    records = run_benchmark(args.networks, args.seeds, args.scenarios, args.workers)
+    write_records(records, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())